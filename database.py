@@ -1,52 +1,75 @@
 # database.py
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-from fastapi import Depends
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
 from dotenv import load_dotenv
 import os
 import asyncio
 
 load_dotenv()
 
-# Create a database connection
-client = AsyncIOMotorClient(os.getenv("MONGO_URI"))
+# Create a database connection with an explicitly sized connection pool
+MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "20"))
+client = AsyncIOMotorClient(
+    os.getenv("MONGO_URI"),
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+    minPoolSize=MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=3000,
+    waitQueueTimeoutMS=2000,
+)
 database = client[os.getenv("DB_NAME")]
 
 # Dependency to get the database
 async def get_database() -> AsyncIOMotorDatabase:
     return database
 
-# Dependency to get the users collection
-### Can add a dependency chain to get the database and then the users collection
-async def get_users_collection(database: AsyncIOMotorDatabase = Depends(get_database)):
-    return database.get_collection("users")
+# Dependencies to get the collections directly, without a Depends(get_database) chain
+# Kept async so FastAPI awaits them inline instead of running them in its threadpool
+async def get_users_collection() -> AsyncIOMotorCollection:
+    return database.users
 
-async def get_products_collection(database: AsyncIOMotorDatabase = Depends(get_database)):
-    return database.get_collection("products")
+async def get_products_collection() -> AsyncIOMotorCollection:
+    return database.products
 
-async def get_carts_collection(database: AsyncIOMotorDatabase = Depends(get_database)):
-    return database.get_collection("carts")
+async def get_carts_collection() -> AsyncIOMotorCollection:
+    return database.carts
+
+# Open the minimum pool's worth of connections up front, with concurrent pings that each
+# need their own connection, so the first burst of requests doesn't pay the connection setup cost
+async def warm_up_connection():
+    await asyncio.gather(*(client.admin.command("ping") for _ in range(max(MIN_POOL_SIZE, 1))))
 
 # Create indexes for better query performance
+# All create_index calls are independent, so they are issued concurrently.
+# Set SKIP_INDEX_ENSURE=1 to skip this on redeploys where the indexes already exist.
 async def create_indexes():
-    # Users collection indexes
-    await database.users.create_index("email", unique=True)
-    await database.users.create_index("cart_id")
-    
-    # Products collection indexes
-    await database.products.create_index("name")
-    await database.products.create_index("category")
-    await database.products.create_index("price")
-    await database.products.create_index("is_active")
-    # Compound index for filtering products by category and price
-    await database.products.create_index([("category", 1), ("price", 1)])
-    # Text index for search functionality
-    await database.products.create_index([("name", "text"), ("description", "text")])
+    if os.getenv("SKIP_INDEX_ENSURE") == "1":
+        print("Skipping database index creation")
+        return
     
-    # Carts collection indexes
-    await database.carts.create_index("user_id", unique=True)
-    # Index for finding items in carts
-    await database.carts.create_index("items.product_id")
+    await asyncio.gather(
+        # Users collection indexes
+        database.users.create_index("email", unique=True),
+        database.users.create_index("cart_id"),
+        
+        # Products collection indexes
+        database.products.create_index("name"),
+        database.products.create_index("price"),
+        # Compound indexes for the list filters, ordered by the ESR rule:
+        # equality fields first, then the sort field, then range fields.
+        # Active products in the default _id order (its prefix also serves is_active-only filters)
+        database.products.create_index([("is_active", 1), ("_id", 1)]),
+        # Filtering products by category and price
+        # (its category prefix also serves category-only filters, so there is no separate category index)
+        database.products.create_index([("category", 1), ("price", 1)]),
+        # Filtering by category and active status, with a price range or price sort
+        database.products.create_index([("category", 1), ("is_active", 1), ("price", 1)]),
+        # Text index for search functionality
+        database.products.create_index([("name", "text"), ("description", "text")]),
+        
+        # Carts collection indexes
+        # Cart lookups and item updates filter on _id, which the default _id index already covers
+        database.carts.create_index("user_id", unique=True),
+        # Index for finding items in carts
+        database.carts.create_index("items.product_id"),
+    )
 
     print("Database indexes created successfully")
-
-
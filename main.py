@@ -5,11 +5,12 @@ from contextlib import asynccontextmanager
 from routes.users import router as user_router
 from routes.products import router as product_router
 from routes.carts import router as cart_router
-from database import create_indexes
+from database import create_indexes, warm_up_connection
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: create indexes
+    # Startup: warm up the connection pool and create indexes
+    await warm_up_connection()
     await create_indexes()
     print("Application started and indexes created")
     yield
@@ -24,4 +25,4 @@ app.include_router(product_router)
 app.include_router(cart_router)
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True)
+    uvicorn.run("main:app", host="127.0.0.1", port=8000, reload=True, loop="uvloop")
@@ -1,6 +1,6 @@
 from typing import List, Optional
-from pydantic import BaseModel, Field
-from bson import ObjectId
+from pydantic import BaseModel, Field, ConfigDict
+from models.user import UserResponse
 
 class CartItem(BaseModel):
     product_id: str = Field(..., description="Reference to the product")
@@ -13,9 +13,7 @@ class CartBase(BaseModel):
 class Cart(CartBase):
     id: str = Field(alias="_id")
     
-    class Config:
-        json_encoders = {ObjectId: str}
-        populate_by_name = True
+    model_config = ConfigDict(populate_by_name=True)
 
 # Input models
 class CartCreate(BaseModel):
@@ -30,4 +28,17 @@ class CartItemUpdate(BaseModel):
 
 # Output models
 class CartResponse(CartBase):
-    id: str 
\ No newline at end of file
+    id: str
+
+class CartCheckoutResponse(BaseModel):
+    message: str
+    new_cart_id: str
+
+class CheckoutProductStock(BaseModel):
+    id: str
+    stock_quantity: int
+    is_active: bool
+
+class CartCheckoutSnapshot(CartCheckoutResponse):
+    user: UserResponse
+    products: List[CheckoutProductStock] = Field(default_factory=list, description="Stock of the checked out products")
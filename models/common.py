@@ -1,4 +1,4 @@
-from typing import Generic, TypeVar, List
+from typing import Generic, TypeVar, List, Optional
 from pydantic import BaseModel
 
 T = TypeVar('T')
@@ -8,4 +8,9 @@ class PaginatedResponse(BaseModel, Generic[T]):
     total: int
     skip: int
     limit: int
-    has_more: bool 
\ No newline at end of file
+    has_more: bool
+    # Pass as after_id to fetch the next page; only set when results are in _id order
+    next_cursor: Optional[str] = None
+
+class MessageResponse(BaseModel):
+    message: str
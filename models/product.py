@@ -1,7 +1,6 @@
 from typing import Optional
 from decimal import Decimal
-from pydantic import BaseModel, Field, field_validator, computed_field
-from bson import ObjectId
+from pydantic import BaseModel, Field, field_validator, field_serializer, computed_field, ConfigDict
 
 class ProductBase(BaseModel):
     name: str = Field(..., min_length=2, description="Product name must be at least 2 characters")
@@ -33,12 +32,13 @@ class ProductBase(BaseModel):
 class Product(ProductBase):
     id: str = Field(alias="_id")
     
-    class Config:
-        json_encoders = {ObjectId: str}
-        populate_by_name = True
+    model_config = ConfigDict(populate_by_name=True)
 
 class ProductCreate(ProductBase):
-    pass
+    @field_serializer('price')
+    def price_as_float(self, v: Decimal) -> float:
+        """Dump the price as a float, which is how it is stored in MongoDB"""
+        return float(v)
 
 class ProductUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=2)
@@ -47,6 +47,20 @@ class ProductUpdate(BaseModel):
     stock_quantity: Optional[int] = Field(None, ge=0)
     category: Optional[str] = None
     # Note: is_active is not included here, so it can't be updated directly
+    
+    @field_validator('name', 'description', 'price', 'stock_quantity')
+    @classmethod
+    def must_not_be_null(cls, v, info):
+        # Only fields sent by the client are validated, so this rejects an explicit null
+        # (unlike category, these fields can be left out but not cleared)
+        if v is None:
+            raise ValueError(f"{info.field_name} cannot be null")
+        return v
+    
+    @field_serializer('price')
+    def price_as_float(self, v: Optional[Decimal]) -> Optional[float]:
+        """Dump the price as a float, which is how it is stored in MongoDB"""
+        return float(v) if v is not None else None
 
 # Output model
 class ProductResponse(ProductBase):
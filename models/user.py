@@ -1,6 +1,5 @@
 from typing import Optional
-from pydantic import BaseModel, Field, EmailStr, field_validator
-from bson import ObjectId
+from pydantic import BaseModel, Field, EmailStr, field_validator, ConfigDict
 
 # Base input/output models
 class UserBase(BaseModel):
@@ -18,9 +17,7 @@ class User(UserBase):
     id: str = Field(alias="_id")
     cart_id: Optional[str] = None  # Reference to the user's shopping cart
 
-    class Config:
-        populate_by_name = True
-        json_encoders = {ObjectId: str}
+    model_config = ConfigDict(populate_by_name=True)
 
 
 # Input models
@@ -32,10 +29,17 @@ class UserResponse(UserBase):
     id: str
     cart_id: Optional[str] = None
     
-    class Config:
-        populate_by_name = True
+    model_config = ConfigDict(populate_by_name=True)
 
 # Add this class after UserResponse
 class UserUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=2)
-    email: Optional[EmailStr] = None 
\ No newline at end of file
+    email: Optional[EmailStr] = None
+    
+    @field_validator('name', 'email')
+    @classmethod
+    def must_not_be_null(cls, v, info):
+        # Only fields sent by the client are validated, so this rejects an explicit null
+        if v is None:
+            raise ValueError(f"{info.field_name} cannot be null")
+        return v 
\ No newline at end of file
@@ -1,11 +1,20 @@
 from fastapi import APIRouter, HTTPException, Depends, Path, Query, Body
 from typing import List, Optional
+import asyncio
 from bson import ObjectId
 from bson.errors import InvalidId
+from routes.common import as_object_id, cached_object_id
 from database import get_carts_collection, get_products_collection, get_users_collection
-from models.cart import CartCreate, CartResponse, Cart, CartItemAdd, CartItemUpdate
+from models.cart import CartCreate, CartResponse, Cart, CartItem, CartItemAdd, CartItemUpdate, CartCheckoutResponse, CartCheckoutSnapshot, CheckoutProductStock
+from models.user import UserResponse
 from motor.motor_asyncio import AsyncIOMotorCollection
-from pymongo import UpdateOne
+from pymongo import UpdateOne, ReturnDocument
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Stock checks only need these fields, not the full product document
+STOCK_PROJECTION = {"stock_quantity": 1, "is_active": 1}
 
 router = APIRouter(
     prefix="/carts",
@@ -13,6 +22,112 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+def cart_response(cart: dict) -> CartResponse:
+    """
+    Build a CartResponse from a cart document without re-validating it.
+    Cart documents are only written by this router from validated input,
+    so the data loaded back from MongoDB is trusted.
+    """
+    items = [CartItem.model_construct(**item) for item in cart["items"]]
+    return CartResponse.model_construct(id=str(cart["_id"]), user_id=cart["user_id"], items=items)
+
+def stock_decrement_pipeline(quantity: int) -> list:
+    """
+    Build an aggregation-pipeline update that decrements a product's stock by
+    quantity (a negative quantity restores stock), clamping it at zero, and
+    derives is_active from the new stock on the server
+    """
+    return [
+        {"$set": {"stock_quantity": {"$max": [0, {"$subtract": ["$stock_quantity", quantity]}]}}},
+        {"$set": {"is_active": {"$gt": ["$stock_quantity", 0]}}}
+    ]
+
+async def checkout_cart(
+    cart_id: str,
+    carts_collection: AsyncIOMotorCollection,
+    users_collection: AsyncIOMotorCollection,
+    products_collection: AsyncIOMotorCollection
+) -> tuple:
+    """
+    Check out a cart: finalize the stock of its items, replace it with a new empty cart
+    and point the user at it. Returns the user, the new cart ID and the checked out product IDs
+    """
+    # Validate cart ID format
+    cart_oid = as_object_id(cart_id, "cart ID")
+    
+    # Get the cart with its items and the user associated with it concurrently
+    cart, user = await asyncio.gather(
+        carts_collection.find_one({"_id": cart_oid}),
+        users_collection.find_one({"cart_id": cart_id})
+    )
+    if not cart:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Cart with ID {cart_id} not found"
+        )
+    
+    if not user:
+        raise HTTPException(
+            status_code=404,
+            detail=f"User associated with cart ID {cart_id} not found"
+        )
+    
+    user_oid = user["_id"]
+    user_id = str(user_oid)
+    
+    # 1. Update stock quantities for all items in the cart (finalize purchase)
+    items = cart.get("items", [])
+    
+    # Group items by product_id to minimize database operations
+    product_quantities = {}
+    for item in items:
+        product_id = item["product_id"]
+        quantity = item["quantity"]
+        product_quantities[product_id] = product_quantities.get(product_id, 0) + quantity
+    
+    # Collect each product's stock update and submit them in a single bulk write.
+    # The aggregation pipeline clamps stock at zero and derives is_active on the
+    # server, so products don't need to be fetched first (missing ones match nothing)
+    operations = []
+    for product_id, quantity in product_quantities.items():
+        operations.append(UpdateOne(
+            {"_id": cached_object_id(product_id)},
+            stock_decrement_pipeline(quantity)
+        ))
+    
+    if operations:
+        await products_collection.bulk_write(operations, ordered=False)
+    
+    # 2. Delete the old cart first so the new one doesn't collide with it on the unique user_id index
+    await carts_collection.delete_one({"_id": cart_oid})
+    
+    # 3. Create a new empty cart for the user, generating its ID up front so the
+    # user's cart_id can be replaced with a single $set at the same time
+    new_cart_oid = ObjectId()
+    new_cart_id = str(new_cart_oid)
+    new_cart_data = {
+        "_id": new_cart_oid,
+        "user_id": user_id,
+        "items": []
+    }
+    
+    _, update_result = await asyncio.gather(
+        carts_collection.insert_one(new_cart_data),
+        users_collection.update_one(
+            {"_id": user_oid},
+            {"$set": {"cart_id": new_cart_id}}
+        )
+    )
+
+    # Verify the update was successful
+    if update_result.modified_count == 0:
+        logger.warning("Failed to update user %s with new cart ID %s", user_id, new_cart_id)
+    else:
+        logger.debug("Updated user %s with new cart ID %s", user_id, new_cart_id)
+    
+    user["cart_id"] = new_cart_id
+    return user, new_cart_id, list(product_quantities)
+
 # Create a shopping cart
 @router.post("/", response_model=CartResponse)
 async def create_cart(
@@ -20,14 +135,14 @@ async def create_cart(
     carts_collection: AsyncIOMotorCollection = Depends(get_carts_collection),
     users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
-    # Validate user exists
-    if not ObjectId.is_valid(cart.user_id):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid user ID format: {cart.user_id}"
-        )
+    # Validate user ID format
+    user_oid = as_object_id(cart.user_id, "user ID")
     
-    user = await users_collection.find_one({"_id": ObjectId(cart.user_id)})
+    # Look up the user and any existing cart concurrently
+    user, existing_cart = await asyncio.gather(
+        users_collection.find_one({"_id": user_oid}),
+        carts_collection.find_one({"user_id": cart.user_id})
+    )
     if not user:
         raise HTTPException(
             status_code=404,
@@ -35,29 +150,30 @@ async def create_cart(
         )
     
     # Check if user already has a cart
-    existing_cart = await carts_collection.find_one({"user_id": cart.user_id})
     if existing_cart:
         raise HTTPException(
             status_code=400,
             detail=f"User with ID {cart.user_id} already has a cart"
         )
     
-    # Create cart
+    # Create cart, generating its ID up front so the user can be updated at the same time
+    cart_object_id = ObjectId()
+    cart_id = str(cart_object_id)
     cart_data = {
         "user_id": cart.user_id,
         "items": []
     }
     
-    result = await carts_collection.insert_one(cart_data)
-    cart_id = str(result.inserted_id)
-    
-    # Update user with cart_id
-    await users_collection.update_one(
-        {"_id": ObjectId(cart.user_id)},
-        {"$set": {"cart_id": cart_id}}
+    # Insert the cart and update user with cart_id
+    await asyncio.gather(
+        carts_collection.insert_one({"_id": cart_object_id, **cart_data}),
+        users_collection.update_one(
+            {"_id": user_oid},
+            {"$set": {"cart_id": cart_id}}
+        )
     )
     
-    return CartResponse(id=cart_id, **cart_data)
+    return CartResponse.model_construct(id=cart_id, **cart_data)
 
 # Get a shopping cart by ID
 @router.get("/{cart_id}", response_model=CartResponse)
@@ -65,20 +181,16 @@ async def get_cart(
     cart_id: str,
     carts_collection: AsyncIOMotorCollection = Depends(get_carts_collection)
 ):
-    if not ObjectId.is_valid(cart_id):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid cart ID format: {cart_id}"
-        )
+    cart_oid = as_object_id(cart_id, "cart ID")
     
-    cart = await carts_collection.find_one({"_id": ObjectId(cart_id)})
+    cart = await carts_collection.find_one({"_id": cart_oid})
     if not cart:
         raise HTTPException(
             status_code=404,
             detail=f"Cart with ID {cart_id} not found"
         )
     
-    return CartResponse(id=str(cart["_id"]), user_id=cart["user_id"], items=cart["items"])
+    return cart_response(cart)
 
 # Add item to a shopping cart
 @router.post("/{cart_id}/items", response_model=CartResponse)
@@ -88,16 +200,12 @@ async def add_item_to_cart(
     carts_collection: AsyncIOMotorCollection = Depends(get_carts_collection),
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
-    # Validate the cart ID
-    if not ObjectId.is_valid(cart_id):
-        raise HTTPException(status_code=400, detail="Invalid cart ID format")
-    
-    # Validate the product ID
-    if not ObjectId.is_valid(item.product_id):
-        raise HTTPException(status_code=400, detail="Invalid product ID format")
+    # Validate the cart ID and product ID
+    cart_oid = as_object_id(cart_id, "cart ID")
+    product_oid = as_object_id(item.product_id, "product ID")
     
     # Check if the product exists and has enough stock
-    product = await products_collection.find_one({"_id": ObjectId(item.product_id)})
+    product = await products_collection.find_one({"_id": product_oid}, STOCK_PROJECTION)
     if not product:
         raise HTTPException(status_code=404, detail=f"Product with ID {item.product_id} not found")
     
@@ -112,48 +220,41 @@ async def add_item_to_cart(
             detail=f"Not enough stock. Requested: {item.quantity}, Available: {product['stock_quantity']}"
         )
     
-    # Try to update an existing item
-    result = await carts_collection.update_one(
-        {
-            "_id": ObjectId(cart_id),
-            "items.product_id": item.product_id
-        },
-        {"$inc": {"items.$.quantity": item.quantity}}
+    # Increment the quantity of an existing item or append a new one in a single atomic update
+    updated_cart = await carts_collection.find_one_and_update(
+        {"_id": cart_oid},
+        [{"$set": {"items": {
+            "$cond": [
+                {"$in": [item.product_id, "$items.product_id"]},
+                {"$map": {
+                    "input": "$items",
+                    "as": "item",
+                    "in": {
+                        "$cond": [
+                            {"$eq": ["$$item.product_id", item.product_id]},
+                            {"product_id": "$$item.product_id", "quantity": {"$add": ["$$item.quantity", item.quantity]}},
+                            "$$item"
+                        ]
+                    }
+                }},
+                {"$concatArrays": ["$items", [{"product_id": item.product_id, "quantity": item.quantity}]]}
+            ]
+        }}}],
+        return_document=ReturnDocument.AFTER
     )
-
-    # If no existing item was updated, add a new one
-    if result.modified_count == 0:
-        # Check if the cart exists
-        cart_exists = await carts_collection.count_documents({"_id": ObjectId(cart_id)}) > 0
-        if not cart_exists:
-            raise HTTPException(status_code=404, detail=f"Cart with ID {cart_id} not found")
-        
-        # Add new item
-        result = await carts_collection.update_one(
-            {"_id": ObjectId(cart_id)},
-            {"$push": {"items": item.model_dump()}}
-        )
     
-    if result.modified_count == 0:
-        raise HTTPException(status_code=400, detail="Failed to update cart")
+    # The pipeline update matches any existing cart, so no document means no cart
+    if not updated_cart:
+        raise HTTPException(status_code=404, detail=f"Cart with ID {cart_id} not found")
     
-    # Update the product's stock quantity
-    new_stock = product["stock_quantity"] - item.quantity
+    # Update the product's stock quantity and active status
     await products_collection.update_one(
-        {"_id": ObjectId(item.product_id)},
-        {"$set": {"stock_quantity": new_stock}}
+        {"_id": product_oid},
+        stock_decrement_pipeline(item.quantity)
     )
     
-    # If stock becomes zero, set the product as inactive
-    if new_stock == 0:
-        await products_collection.update_one(
-            {"_id": ObjectId(item.product_id)},
-            {"$set": {"is_active": False}}
-        )
-    
     # Return the updated cart
-    updated_cart = await carts_collection.find_one({"_id": ObjectId(cart_id)})
-    return CartResponse(id=str(updated_cart["_id"]), user_id=updated_cart["user_id"], items=updated_cart["items"])
+    return cart_response(updated_cart)
 
 # Remove item from a shopping cart
 @router.delete("/{cart_id}/items/{product_id}", response_model=CartResponse)
@@ -164,12 +265,12 @@ async def remove_item_from_cart(
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
     # Validate IDs
-    if not ObjectId.is_valid(cart_id) or not ObjectId.is_valid(product_id):
-        raise HTTPException(status_code=400, detail="Invalid ID format")
+    cart_oid = as_object_id(cart_id, "cart ID")
+    product_oid = as_object_id(product_id, "product ID")
     
     # Find the cart and get the item quantity in a single operation
     pipeline = [
-        {"$match": {"_id": ObjectId(cart_id)}},
+        {"$match": {"_id": cart_oid}},
         {"$project": {
             "user_id": 1,
             "items": 1,
@@ -197,29 +298,29 @@ async def remove_item_from_cart(
     quantity_to_restore = items_to_remove[0]["quantity"]
     
     # Remove the item from the cart
-    update_result = await carts_collection.update_one(
-        {"_id": ObjectId(cart_id)},
-        {"$pull": {"items": {"product_id": product_id}}}
+    updated_cart = await carts_collection.find_one_and_update(
+        {"_id": cart_oid, "items.product_id": product_id},
+        {"$pull": {"items": {"product_id": product_id}}},
+        return_document=ReturnDocument.AFTER
     )
     
-    if update_result.modified_count == 0:
+    if not updated_cart:
         raise HTTPException(status_code=400, detail="Failed to remove item from cart")
     
     # Restore the product's stock quantity
     await products_collection.update_one(
-        {"_id": ObjectId(product_id)},
+        {"_id": product_oid},
         {"$inc": {"stock_quantity": quantity_to_restore}}
     )
     
     # If the product was inactive due to zero stock, make it active again
     await products_collection.update_one(
-        {"_id": ObjectId(product_id), "stock_quantity": {"$gt": 0}, "is_active": False},
+        {"_id": product_oid, "stock_quantity": {"$gt": 0}, "is_active": False},
         {"$set": {"is_active": True}}
     )
     
     # Return the updated cart
-    updated_cart = await carts_collection.find_one({"_id": ObjectId(cart_id)})
-    return CartResponse(id=str(updated_cart["_id"]), user_id=updated_cart["user_id"], items=updated_cart["items"])
+    return cart_response(updated_cart)
 
 # Update item quantity in cart
 @router.put("/{cart_id}/items/{product_id}", response_model=CartResponse)
@@ -231,20 +332,21 @@ async def update_item_quantity(
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
     # Validate IDs
-    if not ObjectId.is_valid(cart_id) or not ObjectId.is_valid(product_id):
-        raise HTTPException(status_code=400, detail="Invalid ID format")
+    cart_oid = as_object_id(cart_id, "cart ID")
+    product_oid = as_object_id(product_id, "product ID")
+    
+    # Get the product to check stock and the current item quantity from the cart concurrently
+    product, cart_with_item = await asyncio.gather(
+        products_collection.find_one({"_id": product_oid}, STOCK_PROJECTION),
+        carts_collection.find_one(
+            {"_id": cart_oid},
+            {"items": {"$elemMatch": {"product_id": product_id}}}
+        )
+    )
     
-    # Get the product to check stock
-    product = await products_collection.find_one({"_id": ObjectId(product_id)})
     if not product:
         raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
     
-    # Get the current item quantity from the cart
-    cart_with_item = await carts_collection.find_one(
-        {"_id": ObjectId(cart_id)},
-        {"items": {"$elemMatch": {"product_id": product_id}}}
-    )
-    
     if not cart_with_item:
         raise HTTPException(status_code=404, detail=f"Cart with ID {cart_id} not found")
     
@@ -262,36 +364,25 @@ async def update_item_quantity(
         )
     
     # Update the item quantity in the cart
-    result = await carts_collection.update_one(
-        {"_id": ObjectId(cart_id), "items.product_id": product_id},
-        {"$set": {"items.$.quantity": item_update.quantity}}
+    updated_cart = await carts_collection.find_one_and_update(
+        {"_id": cart_oid, "items.product_id": product_id},
+        {"$set": {"items.$.quantity": item_update.quantity}},
+        return_document=ReturnDocument.AFTER
     )
     
-    if result.modified_count == 0:
+    if not updated_cart:
         raise HTTPException(status_code=400, detail="Failed to update item quantity")
     
-    # Update the product's stock quantity
-    new_stock = product["stock_quantity"] - quantity_change
-    await products_collection.update_one(
-        {"_id": ObjectId(product_id)},
-        {"$set": {"stock_quantity": new_stock}}
-    )
-    
-    # Update product active status based on stock
-    if new_stock == 0:
+    # Update the product's stock quantity and active status in a single update
+    # (a negative change returns stock to the product)
+    if quantity_change != 0:
         await products_collection.update_one(
-            {"_id": ObjectId(product_id)},
-            {"$set": {"is_active": False}}
-        )
-    elif new_stock > 0 and not product.get("is_active", True):
-        await products_collection.update_one(
-            {"_id": ObjectId(product_id)},
-            {"$set": {"is_active": True}}
+            {"_id": product_oid},
+            stock_decrement_pipeline(quantity_change)
         )
     
     # Return the updated cart
-    updated_cart = await carts_collection.find_one({"_id": ObjectId(cart_id)})
-    return CartResponse(id=str(updated_cart["_id"]), user_id=updated_cart["user_id"], items=updated_cart["items"])
+    return cart_response(updated_cart)
 
 # Clear a shopping cart
 @router.delete("/{cart_id}/items", response_model=CartResponse)
@@ -301,15 +392,13 @@ async def clear_cart(
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
     # Validate cart ID format
-    if not ObjectId.is_valid(cart_id):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid cart ID format: {cart_id}"
-        )
+    cart_oid = as_object_id(cart_id, "cart ID")
     
-    # Get cart items in a single query
-    cart = await carts_collection.find_one(
-        {"_id": ObjectId(cart_id)}
+    # Clear cart items and get the items it held in a single operation
+    cart = await carts_collection.find_one_and_update(
+        {"_id": cart_oid},
+        {"$set": {"items": []}},
+        return_document=ReturnDocument.BEFORE
     )
     
     if not cart:
@@ -321,7 +410,7 @@ async def clear_cart(
     items_to_restore = cart.get("items", [])
     if not items_to_restore:
         # Cart is already empty, just return it
-        return CartResponse(id=str(cart["_id"]), user_id=cart["user_id"], items=[])
+        return CartResponse.model_construct(id=str(cart["_id"]), user_id=cart["user_id"], items=[])
     
     # Group items by product_id to minimize database operations
     product_quantities = {}
@@ -330,130 +419,70 @@ async def clear_cart(
         quantity = item["quantity"]
         product_quantities[product_id] = product_quantities.get(product_id, 0) + quantity
     
-    # Clear cart items
-    await carts_collection.update_one(
-        {"_id": ObjectId(cart_id)},
-        {"$set": {"items": []}}
-    )
-    
-    # Update each product individually
+    # Restore stock for all products in a single bulk write
+    operations = []
     for product_id, quantity in product_quantities.items():
+        product_oid = cached_object_id(product_id)
+        
         # Update stock quantity
-        await products_collection.update_one(
-            {"_id": ObjectId(product_id)},
+        operations.append(UpdateOne(
+            {"_id": product_oid},
             {"$inc": {"stock_quantity": quantity}}
-        )
+        ))
         
         # Set product as active if it was inactive due to zero stock
-        await products_collection.update_one(
-            {"_id": ObjectId(product_id), "stock_quantity": {"$gt": 0}, "is_active": False},
+        operations.append(UpdateOne(
+            {"_id": product_oid, "stock_quantity": {"$gt": 0}, "is_active": False},
             {"$set": {"is_active": True}}
-        )
+        ))
+    
+    if operations:
+        await products_collection.bulk_write(operations, ordered=False)
     
     # Return the updated cart (we already know it's empty)
-    return CartResponse(id=str(cart["_id"]), user_id=cart["user_id"], items=[])
+    return CartResponse.model_construct(id=str(cart["_id"]), user_id=cart["user_id"], items=[])
 
 # Delete a shopping cart
-@router.delete("/{cart_id}")
+@router.delete("/{cart_id}", response_model=CartCheckoutResponse)
 async def delete_cart(
     cart_id: str,
     carts_collection: AsyncIOMotorCollection = Depends(get_carts_collection),
     users_collection: AsyncIOMotorCollection = Depends(get_users_collection),
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
-    # Validate cart ID format
-    if not ObjectId.is_valid(cart_id):
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid cart ID format: {cart_id}"
-        )
-    
-    # Get the cart with its items
-    cart = await carts_collection.find_one({"_id": ObjectId(cart_id)})
-    if not cart:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Cart with ID {cart_id} not found"
-        )
-    
-    # Get the user associated with this cart
-    user = await users_collection.find_one({"cart_id": cart_id})
-    if not user:
-        raise HTTPException(
-            status_code=404,
-            detail=f"User associated with cart ID {cart_id} not found"
-        )
-    
-    user_id = str(user["_id"])
-    
-    # 1. Update stock quantities for all items in the cart (finalize purchase)
-    items = cart.get("items", [])
-    
-    # Group items by product_id to minimize database operations
-    product_quantities = {}
-    for item in items:
-        product_id = item["product_id"]
-        quantity = item["quantity"]
-        product_quantities[product_id] = product_quantities.get(product_id, 0) + quantity
-    
-    # Update each product's stock
-    for product_id, quantity in product_quantities.items():
-        # Verify product exists and has enough stock
-        product = await products_collection.find_one({"_id": ObjectId(product_id)})
-        if not product:
-            continue  # Skip if product doesn't exist
-            
-        # Ensure we don't go below zero stock
-        new_stock = max(0, product["stock_quantity"] - quantity)
-        
-        # Update stock quantity
-        await products_collection.update_one(
-            {"_id": ObjectId(product_id)},
-            {"$set": {"stock_quantity": new_stock}}
-        )
-        
-        # If stock becomes zero, set the product as inactive
-        if new_stock == 0:
-            await products_collection.update_one(
-                {"_id": ObjectId(product_id)},
-                {"$set": {"is_active": False}}
-            )
-    
-    # 2. Remove the cart ID from the user document
-    await users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$unset": {"cart_id": ""}}
-    )
-    
-    # 3. Create a new empty cart for the user
-    new_cart_data = {
-        "user_id": user_id,
-        "items": []
-    }
-    
-    new_cart_result = await carts_collection.insert_one(new_cart_data)
-    new_cart_id = str(new_cart_result.inserted_id)
-    
-    # Update user with the new cart ID
-    update_result = await users_collection.update_one(
-        {"_id": ObjectId(user_id)},
-        {"$set": {"cart_id": new_cart_id}}
-    )
-
-    # Debug: Verify the update was successful
-    if update_result.modified_count == 0:
-        print(f"WARNING: Failed to update user {user_id} with new cart ID {new_cart_id}")
-    else:
-        print(f"Successfully updated user {user_id} with new cart ID {new_cart_id}")
-
-    # Debug: Verify the user document after update
-    updated_user = await users_collection.find_one({"_id": ObjectId(user_id)})
-    print(f"User after update: {updated_user}")
-    
-    # 4. Delete the old cart
-    await carts_collection.delete_one({"_id": ObjectId(cart_id)})
+    _, new_cart_id, _ = await checkout_cart(cart_id, carts_collection, users_collection, products_collection)
     
     return {
         "message": f"Cart with ID {cart_id} checked out successfully",
         "new_cart_id": new_cart_id
-    } 
\ No newline at end of file
+    }
+
+# Check out a cart and return the resulting state of the user and the purchased products
+@router.post("/{cart_id}/checkout", response_model=CartCheckoutSnapshot)
+async def checkout_cart_with_snapshot(
+    cart_id: str,
+    carts_collection: AsyncIOMotorCollection = Depends(get_carts_collection),
+    users_collection: AsyncIOMotorCollection = Depends(get_users_collection),
+    products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
+):
+    user, new_cart_id, product_ids = await checkout_cart(cart_id, carts_collection, users_collection, products_collection)
+    
+    # Read back the updated stock of every checked out product in one query
+    products = await products_collection.find(
+        {"_id": {"$in": [cached_object_id(product_id) for product_id in product_ids]}},
+        STOCK_PROJECTION
+    ).to_list(length=None) if product_ids else []
+    
+    return CartCheckoutSnapshot.model_construct(
+        message=f"Cart with ID {cart_id} checked out successfully",
+        new_cart_id=new_cart_id,
+        user=UserResponse.model_construct(id=str(user["_id"]), name=user["name"], email=user["email"], cart_id=new_cart_id),
+        products=[
+            CheckoutProductStock.model_construct(
+                id=str(product["_id"]),
+                stock_quantity=product["stock_quantity"],
+                is_active=product["stock_quantity"] > 0
+            )
+            for product in products
+        ]
+    )
@@ -0,0 +1,27 @@
+from fastapi import HTTPException
+from bson import ObjectId
+from functools import lru_cache
+import re
+
+# An ObjectId string is exactly 24 hex characters
+OBJECT_ID_PATTERN = re.compile(r"[0-9a-fA-F]{24}")
+
+@lru_cache(maxsize=1024)
+def cached_object_id(value: str) -> ObjectId:
+    """
+    Parse a well-formed ID string into an ObjectId, reusing the result for IDs seen recently.
+    ObjectIds are immutable, so the cached instances can be shared across requests
+    """
+    return ObjectId(value)
+
+def as_object_id(value: str, label: str) -> ObjectId:
+    """
+    Parse an ID string into an ObjectId, raising a 400 error if it is malformed.
+    Malformed IDs are rejected by a precompiled pattern, without ObjectId() raising InvalidId
+    """
+    if not isinstance(value, str) or OBJECT_ID_PATTERN.fullmatch(value) is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid {label} format: {value}. Must be a 24-character hex string."
+        )
+    return cached_object_id(value)
@@ -1,12 +1,20 @@
 from fastapi import APIRouter, HTTPException, Depends, Query, Path, Body
-from typing import Optional, List
-from bson import ObjectId
+from typing import Optional, List, Literal
 from bson.errors import InvalidId
 from decimal import Decimal
+import re
+import json
+import time
+import asyncio
+from routes.common import as_object_id
 from database import get_products_collection
-from models.product import ProductCreate, ProductResponse, Product, ProductUpdate
-from models.common import PaginatedResponse
+from models.product import ProductCreate, ProductResponse, ProductUpdate
+from models.common import PaginatedResponse, MessageResponse
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/products",
@@ -14,22 +22,51 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-def convert_decimal_to_float(data: dict) -> dict:
-    """Convert Decimal values to float for MongoDB storage"""
-    for key, value in data.items():
-        if isinstance(value, Decimal):
-            data[key] = float(value)
-    return data
+# List queries only fetch the fields the response model uses (is_active is computed from stock_quantity)
+PRODUCT_PROJECTION = {field: 1 for field in ProductResponse.model_fields if field != "id"}
+TEXT_SEARCH_PROJECTION = {**PRODUCT_PROJECTION, "score": {"$meta": "textScore"}}
+
+# Sort orders shared by every list request
+DEFAULT_SORT = [("_id", 1)]  # Default sort by ID
+TEXT_SCORE_SORT = [("score", {"$meta": "textScore"})]  # Best text matches first
+
+# Filtered counts are cached for a few seconds, since the list total does not need to be exact
+COUNT_CACHE_TTL = 5.0
+COUNT_CACHE_MAX_SIZE = 1024
+count_cache = {}
+
+async def count_products(products_collection: AsyncIOMotorCollection, query: dict) -> int:
+    """Count the products matching a query, reusing a recent count for the same query"""
+    if not query:
+        # Unfiltered counts come from collection metadata
+        return await products_collection.estimated_document_count()
+    
+    key = json.dumps(query, sort_keys=True, default=str)
+    cached = count_cache.get(key)
+    now = time.monotonic()
+    if cached is not None and now - cached[0] < COUNT_CACHE_TTL:
+        return cached[1]
+    
+    count = await products_collection.count_documents(query)
+    if len(count_cache) >= COUNT_CACHE_MAX_SIZE:
+        count_cache.clear()
+    count_cache[key] = (now, count)
+    return count
+
+def product_response(product: dict) -> ProductResponse:
+    """Build a response model from a stored product, without re-validating it since it comes from our own collection"""
+    return ProductResponse.model_construct(
+        id=str(product["_id"]),
+        name=product["name"],
+        description=product["description"],
+        price=Decimal(str(product["price"])),  # Stored as a float
+        stock_quantity=product["stock_quantity"],
+        category=product.get("category")
+    )
 
-def prepare_product_data(product_data: dict) -> dict:
-    """
-    Prepare product data for response by converting ObjectId to string
-    and handling any other necessary conversions
-    """
-    return {
-        **product_data,
-        "_id": str(product_data["_id"])  # Convert ObjectId to string
-    }
+async def product_page(cursor) -> List[ProductResponse]:
+    """Build response models as documents arrive from the cursor"""
+    return [product_response(product) async for product in cursor]
 
 # Create a new product
 @router.post("/", response_model=ProductResponse)
@@ -38,8 +75,6 @@ async def create_product(
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
     product_data = product.model_dump()
-    # Convert Decimal to float for MongoDB storage
-    product_data = convert_decimal_to_float(product_data)
     # Always derive is_active from stock_quantity
     product_data["is_active"] = product_data["stock_quantity"] > 0
     result = await products_collection.insert_one(product_data)
@@ -51,39 +86,30 @@ async def get_product(
     product_id: str, 
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
-    # Validate ID format
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid product ID format: {product_id}. Must be a 24-character hex string."
-        )
-    
-    # Create ObjectId after validation
-    object_id = ObjectId(product_id)
+    # Parse and validate the ID
+    object_id = as_object_id(product_id, "product ID")
     
     # Find the product
-    product_data = await products_collection.find_one({"_id": object_id})
+    product_data = await products_collection.find_one({"_id": object_id}, PRODUCT_PROJECTION)
     
     # Check if product exists
     if product_data is None:
         raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
     
     try:
-        # Use helper function to prepare data
-        product_dict = prepare_product_data(product_data)
-        product = Product(**product_dict)
-        return ProductResponse(**product.model_dump(by_alias=False))
+        return product_response(product_data)
         
     except Exception as e:
         # Log the error
-        print(f"Error in get_product: {str(e)}")
+        logger.exception("get_product failed for product ID %s", product_id)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 # Get a paginated list of products with sorting and filtering
 @router.get("/", response_model=PaginatedResponse[ProductResponse])
 async def get_products(
-    skip: int = Query(0, ge=0, description="Number of products to skip"),
+    skip: int = Query(0, ge=0, deprecated=True, description="Number of products to skip (deprecated, use after_id)"),
     limit: int = Query(10, ge=1, le=100, description="Max number of products to return"),
+    after_id: Optional[str] = Query(None, description="Return products after this ID (the next_cursor of the previous page)"),
     sort_by: Optional[str] = Query(None, description="Field to sort by (e.g., 'price', 'name')"),
     sort_order: int = Query(1, ge=-1, le=1, description="Sort order: 1 for ascending, -1 for descending"),
     min_price: Optional[float] = Query(None, ge=0, description="Minimum price filter"),
@@ -91,8 +117,18 @@ async def get_products(
     category: Optional[str] = Query(None, description="Filter by category"),
     is_active: Optional[bool] = Query(None, description="Filter by active status"),
     search: Optional[str] = Query(None, description="Search in name and description"),
+    search_mode: Literal["text", "prefix", "regex"] = Query(
+        "text",
+        description="'text' uses the text index, 'prefix' matches the start of the name (case-sensitive), 'regex' does a case-insensitive substring match"
+    ),
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
+    # Validate the keyset cursor
+    if after_id is not None:
+        after_oid = as_object_id(after_id, "after_id")
+        if sort_by:
+            raise HTTPException(status_code=400, detail="after_id cannot be combined with sort_by")
+    
     # Build filter query
     query = {}
     
@@ -113,77 +149,84 @@ async def get_products(
     if is_active is not None:
         query["is_active"] = is_active
     
-    # Text search
-    if search:
+    # Text search, using the text index on name and description unless regex matching is requested
+    projection = PRODUCT_PROJECTION
+    if search and search_mode == "text":
+        query["$text"] = {"$search": search}
+        projection = TEXT_SEARCH_PROJECTION
+    elif search and search_mode == "prefix":
+        # A case-sensitive anchored pattern gets tight bounds on the name index, so the server
+        # only scans the keys starting with the prefix (the "i" option would scan every key)
+        query["name"] = {"$regex": f"^{re.escape(search)}"}
+    elif search:
+        # Escape the search term so it is matched literally
+        pattern = re.escape(search)
         query["$or"] = [
-            {"name": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}}
+            {"name": {"$regex": pattern, "$options": "i"}},
+            {"description": {"$regex": pattern, "$options": "i"}}
         ]
     
-    # Get total count for pagination metadata
-    total_count = await products_collection.count_documents(query)
-    
     # Build sort query
-    sort_query = []
     if sort_by:
-        sort_query.append((sort_by, sort_order))
+        sort_query = [(sort_by, sort_order)]
+    elif "$text" in query and after_id is None:
+        sort_query = TEXT_SCORE_SORT
     else:
-        sort_query.append(("_id", 1))  # Default sort by ID
+        sort_query = DEFAULT_SORT
     
-    # Get paginated products
-    cursor = products_collection.find(query).sort(sort_query).skip(skip).limit(limit)
-    products = await cursor.to_list(length=limit)
-    
-    # Convert to response models using helper function
-    product_responses = [
-        ProductResponse(**{k: v for k, v in prepare_product_data(product).items() if k != "_id"}, id=str(product["_id"]))
-        for product in products
-    ]
+    # Get the total count for pagination metadata and the paginated products concurrently
+    if after_id is not None:
+        # Keyset pagination: seek past the cursor on the _id index instead of skipping documents,
+        # fetching one extra product to know whether there is another page
+        page_query = {**query, "_id": {"$gt": after_oid}}
+        cursor = products_collection.find(page_query, projection).sort(sort_query).limit(limit + 1)
+        total_count, product_responses = await asyncio.gather(
+            count_products(products_collection, query),
+            product_page(cursor)
+        )
+        has_more = len(product_responses) > limit
+        product_responses = product_responses[:limit]
+    else:
+        cursor = products_collection.find(query, projection).sort(sort_query).skip(skip).limit(limit)
+        total_count, product_responses = await asyncio.gather(
+            count_products(products_collection, query),
+            product_page(cursor)
+        )
+        # The count may be cached, so a short page also means there is nothing after it
+        has_more = len(product_responses) == limit and (skip + limit) < total_count
     
     # Return with pagination metadata
     return PaginatedResponse(
         items=product_responses,
         total=total_count,
-        skip=skip,
+        skip=0 if after_id is not None else skip,
         limit=limit,
-        has_more=(skip + limit) < total_count
+        has_more=has_more,
+        next_cursor=product_responses[-1].id if has_more and product_responses and sort_query is DEFAULT_SORT else None
     )
 
 # Delete a product
-@router.delete("/{product_id}")
+@router.delete("/{product_id}", response_model=MessageResponse)
 async def delete_product(
     product_id: str, 
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
-    # Validate ID format
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid product ID format: {product_id}. Must be a 24-character hex string."
-        )
+    # Parse and validate the ID
+    object_id = as_object_id(product_id, "product ID")
     
-    # Create ObjectId after validation
-    object_id = ObjectId(product_id)
-    
-    # First check if the product exists
-    product = await products_collection.find_one({"_id": object_id})
-    if not product:
-        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
-        
     try:
-        # Delete the product
-        result = await products_collection.delete_one({"_id": object_id})
-        
-        if result.deleted_count == 0:
-            # This should rarely happen since we already checked existence
-            raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
-            
-        return {"message": f"Product with ID {product_id} deleted successfully"}
+        # Delete the product, getting it back to know whether it existed
+        deleted_product = await products_collection.find_one_and_delete({"_id": object_id}, {"_id": 1})
         
     except Exception as e:
         # Log the error
-        print(f"Error in delete_product: {str(e)}")
+        logger.exception("delete_product failed for product ID %s", product_id)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    
+    if deleted_product is None:
+        raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
+        
+    return {"message": f"Product with ID {product_id} deleted successfully"}
 
 # Update a product (full update)
 @router.put("/{product_id}", response_model=ProductResponse)
@@ -192,46 +235,37 @@ async def update_product(
     product: ProductCreate,
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
-    # Validate ID format
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid product ID format: {product_id}. Must be a 24-character hex string."
-        )
+    # Parse and validate the ID
+    object_id = as_object_id(product_id, "product ID")
     
-    # Create ObjectId after validation
-    object_id = ObjectId(product_id)
+    # Prepare the new product data
+    product_data = product.model_dump()
+    # Always derive is_active from stock_quantity
+    product_data["is_active"] = product_data["stock_quantity"] > 0
+    
+    try:
+        # Update the product and get the updated document in a single operation
+        updated_product = await products_collection.find_one_and_update(
+            {"_id": object_id},
+            {"$set": product_data},
+            return_document=ReturnDocument.AFTER
+        )
+        
+    except Exception as e:
+        # Log the error
+        logger.exception("update_product failed for product ID %s", product_id)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     
     # Check if product exists
-    existing_product = await products_collection.find_one({"_id": object_id})
-    if not existing_product:
+    if updated_product is None:
         raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
     
     try:
-        # Update the product
-        product_data = product.model_dump()
-        # Convert Decimal to float for MongoDB storage
-        product_data = convert_decimal_to_float(product_data)
-        # Always derive is_active from stock_quantity
-        product_data["is_active"] = product_data["stock_quantity"] > 0
-        
-        result = await products_collection.replace_one(
-            {"_id": object_id}, 
-            product_data
-        )
-        
-        if result.modified_count == 0:
-            # If no changes were made
-            return ProductResponse(id=product_id, **product_data)
-        
-        # Get the updated product
-        updated_product = await products_collection.find_one({"_id": object_id})
-        product_dict = prepare_product_data(updated_product)
-        return ProductResponse(**{k: v for k, v in product_dict.items() if k != "_id"}, id=product_dict["_id"])
+        return ProductResponse(id=str(updated_product.pop("_id")), **updated_product)
         
     except Exception as e:
         # Log the error
-        print(f"Error in update_product: {str(e)}")
+        logger.exception("update_product failed for product ID %s", product_id)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 # Partially update a product
@@ -241,52 +275,43 @@ async def patch_product(
     product_update: ProductUpdate,
     products_collection: AsyncIOMotorCollection = Depends(get_products_collection)
 ):
-    # Validate ID format
-    if not ObjectId.is_valid(product_id):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid product ID format: {product_id}. Must be a 24-character hex string."
-        )
+    # Parse and validate the ID
+    object_id = as_object_id(product_id, "product ID")
     
-    # Create ObjectId after validation
-    object_id = ObjectId(product_id)
+    # Get only the fields that were provided for the update
+    update_data = product_update.model_dump(exclude_unset=True)
+    
+    try:
+        if update_data:
+            # Update the product with only the provided fields and get back just the response fields.
+            # The pipeline re-derives is_active from the resulting stock_quantity on the server;
+            # values are wrapped in $literal so strings starting with "$" are not read as field paths
+            updated_product = await products_collection.find_one_and_update(
+                {"_id": object_id}, 
+                [
+                    {"$set": {k: {"$literal": v} for k, v in update_data.items()}},
+                    {"$set": {"is_active": {"$gt": ["$stock_quantity", 0]}}}
+                ],
+                projection=PRODUCT_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+        else:
+            # If no fields to update, return the existing product
+            updated_product = await products_collection.find_one({"_id": object_id}, PRODUCT_PROJECTION)
+        
+    except Exception as e:
+        # Log the error
+        logger.exception("patch_product failed for product ID %s", product_id)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     
     # Check if product exists
-    existing_product = await products_collection.find_one({"_id": object_id})
-    if not existing_product:
+    if updated_product is None:
         raise HTTPException(status_code=404, detail=f"Product with ID {product_id} not found")
     
     try:
-        # Get only the fields that were provided for the update
-        update_data = {k: v for k, v in product_update.model_dump().items() if v is not None}
-        
-        if not update_data:
-            # If no fields to update, return the existing product
-            return ProductResponse(id=product_id, **{k: v for k, v in existing_product.items() if k != "_id"})
-        
-        # Convert Decimal to float for MongoDB storage
-        update_data = convert_decimal_to_float(update_data)
-        
-        # If stock_quantity is being updated, update is_active accordingly
-        if "stock_quantity" in update_data:
-            update_data["is_active"] = update_data["stock_quantity"] > 0
-        
-        # Update the product with only the provided fields
-        result = await products_collection.update_one(
-            {"_id": object_id}, 
-            {"$set": update_data}
-        )
-        
-        # Get the updated product
-        updated_product = await products_collection.find_one({"_id": object_id})
-        product_dict = prepare_product_data(updated_product)
-        
-        # Ensure is_active is always based on stock_quantity
-        product_dict["is_active"] = product_dict["stock_quantity"] > 0
-        
-        return ProductResponse(**{k: v for k, v in product_dict.items() if k != "_id"}, id=product_dict["_id"])
+        return ProductResponse(id=str(updated_product.pop("_id")), **updated_product)
         
     except Exception as e:
         # Log the error
-        print(f"Error in patch_product: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}") 
\ No newline at end of file
+        logger.exception("patch_product failed for product ID %s", product_id)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
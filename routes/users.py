@@ -1,10 +1,18 @@
 from fastapi import APIRouter, HTTPException, Depends, Path, Query
+from typing import Optional, List
 from bson import ObjectId
 from bson.errors import InvalidId
+import asyncio
+from routes.common import as_object_id
 from database import get_users_collection, get_carts_collection
-from models.user import UserCreate, UserResponse, User, UserUpdate
-from models.common import PaginatedResponse
+from models.user import UserCreate, UserResponse, UserUpdate
+from models.common import PaginatedResponse, MessageResponse
 from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/users",
@@ -12,6 +20,17 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+# List queries only fetch the fields the response model uses
+USER_PROJECTION = {field: 1 for field in UserResponse.model_fields if field != "id"}
+
+def user_response(user: dict) -> UserResponse:
+    """Build a response model from a stored user, without re-validating it since it comes from our own collection"""
+    return UserResponse.model_construct(id=str(user["_id"]), name=user["name"], email=user["email"], cart_id=user.get("cart_id"))
+
+async def user_page(cursor) -> List[UserResponse]:
+    """Build response models as documents arrive from the cursor"""
+    return [user_response(user) async for user in cursor]
+
 # Create a new user
 @router.post("/", response_model=UserResponse)
 async def create_user(
@@ -59,106 +78,83 @@ async def create_user(
 # Get all users
 @router.get("/", response_model=PaginatedResponse[UserResponse])
 async def get_users(
-    skip: int = Query(0, ge=0, description="Number of users to skip"),
+    skip: int = Query(0, ge=0, deprecated=True, description="Number of users to skip (deprecated, use after_id)"),
     limit: int = Query(10, ge=1, le=100, description="Max number of users to return"),
+    after_id: Optional[str] = Query(None, description="Return users after this ID (the next_cursor of the previous page)"),
     users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
-    # Get total count for pagination metadata
-    total_count = await users_collection.count_documents({})
-    
-    # Get paginated users
-    users = await users_collection.find().skip(skip).limit(limit).to_list(length=limit)
-    
-    # Convert to response models
-    user_responses = [
-        UserResponse(id=str(user["_id"]), name=user["name"], email=user["email"], cart_id=user.get("cart_id")) 
-        for user in users
-    ]
+    # Get the total count for pagination metadata and the paginated users concurrently
+    if after_id is not None:
+        after_oid = as_object_id(after_id, "after_id")
+        
+        # Keyset pagination: seek past the cursor on the _id index instead of skipping documents,
+        # fetching one extra user to know whether there is another page
+        cursor = users_collection.find({"_id": {"$gt": after_oid}}, USER_PROJECTION).sort("_id", 1).limit(limit + 1)
+        total_count, user_responses = await asyncio.gather(
+            users_collection.estimated_document_count(),
+            user_page(cursor)
+        )
+        has_more = len(user_responses) > limit
+        user_responses = user_responses[:limit]
+    else:
+        cursor = users_collection.find({}, USER_PROJECTION).sort("_id", 1).skip(skip).limit(limit)
+        total_count, user_responses = await asyncio.gather(
+            users_collection.estimated_document_count(),
+            user_page(cursor)
+        )
+        # The count is an estimate, so a short page also means there is nothing after it
+        has_more = len(user_responses) == limit and (skip + limit) < total_count
     
     # Return with pagination metadata
     return PaginatedResponse(
         items=user_responses,
         total=total_count,
-        skip=skip,
+        skip=0 if after_id is not None else skip,
         limit=limit,
-        has_more=(skip + limit) < total_count
+        has_more=has_more,
+        next_cursor=user_responses[-1].id if has_more and user_responses else None
     )
 
 # Get a user by ID
 @router.get("/{user_id}", response_model=UserResponse)
 async def get_user(user_id: str, users_collection: AsyncIOMotorCollection = Depends(get_users_collection)):
-    # First validate the ID format before any database operations
-    if not ObjectId.is_valid(user_id):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid user ID format: {user_id}. Must be a 24-character hex string."
-        )
-    
-    # Create ObjectId after validation
-    object_id = ObjectId(user_id)
+    # Parse and validate the ID
+    object_id = as_object_id(user_id, "user ID")
     
     # Find the user
-    user_data = await users_collection.find_one({"_id": object_id})
+    user_data = await users_collection.find_one({"_id": object_id}, USER_PROJECTION)
     
     # Check if user exists - do this outside the try/except block
     if user_data is None:
         raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
     
     try:
-        # Convert the MongoDB document to a dictionary
-        user_dict = {
-            "_id": str(user_data["_id"]),
-            "name": user_data["name"],
-            "email": user_data["email"],
-        }
-        
-        # Add cart_id if it exists in the document
-        if "cart_id" in user_data:
-            user_dict["cart_id"] = user_data["cart_id"]
-        
-        # Create the User object
-        user = User(**user_dict)
-        
-        # Convert to response model
-        return UserResponse(**user.model_dump(by_alias=False))
+        return user_response(user_data)
         
     except Exception as e:
         # Log the error
-        print(f"Error in get_user: {str(e)}")
+        logger.exception("get_user failed for user ID %s", user_id)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 # Delete a user by ID
-@router.delete("/{user_id}")
+@router.delete("/{user_id}", response_model=MessageResponse)
 async def delete_user(user_id: str, users_collection: AsyncIOMotorCollection = Depends(get_users_collection)):
-    # First validate the ID format before any database operations
-    if not ObjectId.is_valid(user_id):
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid user ID format: {user_id}. Must be a 24-character hex string."
-        )
-    
-    # Create ObjectId after validation
-    object_id = ObjectId(user_id)
+    # Parse and validate the ID
+    object_id = as_object_id(user_id, "user ID")
     
-    # First check if the user exists
-    user = await users_collection.find_one({"_id": object_id})
-    if not user:
-        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
-        
     try:
-        # Delete the user
-        result = await users_collection.delete_one({"_id": object_id})
-        
-        if result.deleted_count == 0:
-            # This should rarely happen since we already checked existence
-            raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
-            
-        return {"message": f"User with ID {user_id} deleted successfully"}
+        # Delete the user, getting it back to know whether it existed
+        deleted_user = await users_collection.find_one_and_delete({"_id": object_id}, {"_id": 1})
         
     except Exception as e:
         # Log the error
-        print(f"Error in delete_user: {str(e)}")
+        logger.exception("delete_user failed for user ID %s", user_id)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    
+    if deleted_user is None:
+        raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
+        
+    return {"message": f"User with ID {user_id} deleted successfully"}
 
 # Update a user (full update)
 @router.put("/{user_id}", response_model=UserResponse)
@@ -167,40 +163,38 @@ async def update_user(
     user: UserCreate,
     users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
-    # Validate ID format
-    if not ObjectId.is_valid(user_id):
+    # Parse and validate the ID
+    object_id = as_object_id(user_id, "user ID")
+    
+    try:
+        # Update the user and get the updated document in a single operation
+        # ($set rather than a replacement, so the user keeps its cart_id)
+        updated_user = await users_collection.find_one_and_update(
+            {"_id": object_id}, 
+            {"$set": user.model_dump()},
+            return_document=ReturnDocument.AFTER
+        )
+        
+    except DuplicateKeyError:
         raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid user ID format: {user_id}. Must be a 24-character hex string."
+            status_code=400,
+            detail=f"User with email {user.email} already exists"
         )
-    
-    # Create ObjectId after validation
-    object_id = ObjectId(user_id)
+    except Exception as e:
+        # Log the error
+        logger.exception("update_user failed for user ID %s", user_id)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     
     # Check if user exists
-    existing_user = await users_collection.find_one({"_id": object_id})
-    if not existing_user:
+    if updated_user is None:
         raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
     
     try:
-        # Update the user
-        user_data = user.model_dump()
-        result = await users_collection.replace_one(
-            {"_id": object_id}, 
-            user_data
-        )
-        
-        if result.modified_count == 0:
-            # If no changes were made
-            return UserResponse(id=user_id, **user_data)
-        
-        # Get the updated user
-        updated_user = await users_collection.find_one({"_id": object_id})
         return UserResponse(id=str(updated_user["_id"]), **{k: v for k, v in updated_user.items() if k != "_id"})
         
     except Exception as e:
         # Log the error
-        print(f"Error in update_user: {str(e)}")
+        logger.exception("update_user failed for user ID %s", user_id)
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 # Partially update a user
@@ -210,40 +204,43 @@ async def patch_user(
     user_update: UserUpdate,
     users_collection: AsyncIOMotorCollection = Depends(get_users_collection)
 ):
-    # Validate ID format
-    if not ObjectId.is_valid(user_id):
+    # Parse and validate the ID
+    object_id = as_object_id(user_id, "user ID")
+    
+    # Get only the fields that were provided for the update
+    update_data = user_update.model_dump(exclude_unset=True)
+    
+    try:
+        if update_data:
+            # Update the user with only the provided fields and get back just the response fields
+            updated_user = await users_collection.find_one_and_update(
+                {"_id": object_id}, 
+                {"$set": update_data},
+                projection=USER_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+        else:
+            # If no fields to update, return the existing user
+            updated_user = await users_collection.find_one({"_id": object_id}, USER_PROJECTION)
+        
+    except DuplicateKeyError:
         raise HTTPException(
-            status_code=400, 
-            detail=f"Invalid user ID format: {user_id}. Must be a 24-character hex string."
+            status_code=400,
+            detail=f"User with email {update_data['email']} already exists"
         )
-    
-    # Create ObjectId after validation
-    object_id = ObjectId(user_id)
+    except Exception as e:
+        # Log the error
+        logger.exception("patch_user failed for user ID %s", user_id)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     
     # Check if user exists
-    existing_user = await users_collection.find_one({"_id": object_id})
-    if not existing_user:
+    if updated_user is None:
         raise HTTPException(status_code=404, detail=f"User with ID {user_id} not found")
     
     try:
-        # Get only the fields that were provided for the update
-        update_data = {k: v for k, v in user_update.model_dump().items() if v is not None}
-        
-        if not update_data:
-            # If no fields to update, return the existing user
-            return UserResponse(id=user_id, **{k: v for k, v in existing_user.items() if k != "_id"})
-        
-        # Update the user with only the provided fields
-        result = await users_collection.update_one(
-            {"_id": object_id}, 
-            {"$set": update_data}
-        )
-        
-        # Get the updated user
-        updated_user = await users_collection.find_one({"_id": object_id})
         return UserResponse(id=str(updated_user["_id"]), **{k: v for k, v in updated_user.items() if k != "_id"})
         
     except Exception as e:
         # Log the error
-        print(f"Error in patch_user: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}") 
\ No newline at end of file
+        logger.exception("patch_user failed for user ID %s", user_id)
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}") 
@@ -1,12 +1,20 @@
 import pytest
+import pytest_asyncio
+import asyncio
 import sys
 import os
-from fastapi.testclient import TestClient
+import uvloop
+from httpx import AsyncClient, ASGITransport
 from mongomock_motor import AsyncMongoMockClient
 
 # Add the crush-mongo directory to the Python path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+# The app builds its Motor client at import time, so give it a database config even when no
+# .env is present. The client never connects: setup_test_db swaps in mongomock for every test.
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_bookstore")
+
 # Now import directly from the modules
 from main import app
 from database import client as app_client, database as app_database
@@ -14,33 +22,65 @@ from database import client as app_client, database as app_database
 # Test database name
 TEST_DB_NAME = "test_bookstore"
 
-@pytest.fixture
-def client():
-    """Create a test client for the FastAPI app."""
-    return TestClient(app)
+# The transport holds no per-test state, so every test's client shares one
+transport = ASGITransport(app=app)
 
-@pytest.fixture(autouse=True)
-def setup_test_db():
-    """Set up the test database before each test."""
-    # Create a mock client
-    client = AsyncMongoMockClient()
-    
+def pytest_asyncio_loop_factories(config, item):
+    """Run the async tests on uvloop, like the server does."""
+    return {"uvloop": uvloop.new_event_loop}
+
+@pytest_asyncio.fixture
+async def client():
+    """Create an async test client that calls the FastAPI app in-process."""
+    async with AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
+
+# One in-memory mock client serves the whole run; its test database is dropped after every test
+mock_client = AsyncMongoMockClient()
+
+@pytest_asyncio.fixture(autouse=True)
+async def setup_test_db():
+    """Set up the test database before each test and drop it afterwards."""
     # Store original database connections
     original_client = app_client
     original_database = app_database
     
     # Override the app's database connection with our test database
     import database
-    database.client = client
-    database.database = client[TEST_DB_NAME]
+    database.client = mock_client
+    database.database = mock_client[TEST_DB_NAME]
+    
+    # Don't let cached product counts leak between tests
+    from routes import products
+    products.count_cache.clear()
     
     yield
     
+    # Dropping the database resets every collection and index in one step
+    await mock_client.drop_database(TEST_DB_NAME)
+    
     # Restore original database connection
     import database
     database.client = original_client
     database.database = original_database
 
+@pytest.fixture
+def test_db(setup_test_db):
+    """The in-memory test database the API is pointed at, for asserting on stored state directly."""
+    import database
+    return database.database
+
+@pytest.fixture
+def get_stock(test_db):
+    """Read a product's stock quantity straight from the test database."""
+    async def _get_stock(product_id):
+        from bson import ObjectId
+        
+        product = await test_db.products.find_one({"_id": ObjectId(product_id)}, {"stock_quantity": 1})
+        return product["stock_quantity"]
+    
+    return _get_stock
+
 # Test data fixtures
 @pytest.fixture
 def sample_user_data():
@@ -59,49 +99,119 @@ def sample_product_data():
         "category": "Test Category"
     }
 
-@pytest.fixture
-def create_test_user(client, sample_user_data):
+@pytest_asyncio.fixture
+async def create_test_user(client, sample_user_data):
     """Create a test user and return the user data."""
-    response = client.post("/users/", json=sample_user_data)
+    response = await client.post("/users/", json=sample_user_data)
     return response.json()
 
-@pytest.fixture
-def create_test_product(client, sample_product_data):
+@pytest_asyncio.fixture
+async def create_test_product(client, sample_product_data):
     """Create a test product and return the product data."""
-    response = client.post("/products/", json=sample_product_data)
+    response = await client.post("/products/", json=sample_product_data)
     return response.json()
 
-@pytest.fixture
-def create_test_cart_with_items(client, create_test_user, create_test_product):
+@pytest_asyncio.fixture
+async def create_test_cart_with_items(test_db, sample_user_data, sample_product_data):
     """Create a test cart with items and return the cart data."""
-    user = create_test_user
-    product = create_test_product
+    from bson import ObjectId
+    
+    # Insert the documents the API would have stored for a user whose cart holds
+    # 2 of a product, without going through the routes
+    user_id, cart_id, product_id = ObjectId(), ObjectId(), ObjectId()
+    quantity = 2
+    stock_quantity = sample_product_data["stock_quantity"] - quantity
     
-    # The cart should already be created with the user
-    cart_id = user["cart_id"]
+    await asyncio.gather(
+        test_db.users.insert_one({"_id": user_id, **sample_user_data, "cart_id": str(cart_id)}),
+        test_db.products.insert_one({
+            "_id": product_id,
+            **sample_product_data,
+            "stock_quantity": stock_quantity,
+            "is_active": stock_quantity > 0
+        }),
+        test_db.carts.insert_one({
+            "_id": cart_id,
+            "user_id": str(user_id),
+            "items": [{"product_id": str(product_id), "quantity": quantity}]
+        })
+    )
     
-    # Add an item to the cart
-    item_data = {
-        "product_id": product["id"],
-        "quantity": 2
+    return {
+        "id": str(cart_id),
+        "user_id": str(user_id),
+        "items": [{"product_id": str(product_id), "quantity": quantity}]
     }
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
-    return response.json()
 
 @pytest.fixture
 def get_user_from_db():
-    """Get a user directly from the database."""
-    async def _get_user(user_id):
+    """Get users directly from the database."""
+    async def _get_users(user_ids):
         from bson import ObjectId
-        from motor.motor_asyncio import AsyncIOMotorClient
-        
-        # Use the same connection string as your API
-        client = AsyncIOMotorClient("mongodb+srv://<REDACTED>")
-        db = client["bookstore"]
-        users_collection = db["users"]
+        import database
         
-        user = await users_collection.find_one({"_id": ObjectId(user_id)})
-        return user
+        # Use the test database the API is pointed at, rather than opening a new client per call,
+        # and fetch all the users in one query
+        users_collection = database.database["users"]
+        return await users_collection.find({"_id": {"$in": [ObjectId(user_id) for user_id in user_ids]}}).to_list(None)
     
-    return _get_user 
+    return _get_users 
 
+class RecordingCursor:
+    """Stand-in for a Motor cursor that records the sort, skip and limit applied to it."""
+    def __init__(self, docs):
+        self.docs = docs
+        self.sort_query = None
+    
+    def sort(self, sort_query):
+        self.sort_query = sort_query
+        return self
+    
+    def skip(self, skip):
+        return self
+    
+    def limit(self, limit):
+        return self
+    
+    async def __aiter__(self):
+        for doc in self.docs:
+            yield doc
+
+class RecordingCollection:
+    """Stand-in for a Motor collection that records every find() it is given."""
+    def __init__(self, docs):
+        self.docs = docs
+        self.finds = []
+    
+    def find(self, query, projection=None):
+        cursor = RecordingCursor(self.docs)
+        self.finds.append((query, projection, cursor))
+        return cursor
+    
+    async def count_documents(self, query):
+        return len(self.docs)
+    
+    async def estimated_document_count(self):
+        return len(self.docs)
+
+@pytest.fixture
+def recording_products_collection():
+    """
+    Serve the products routes from a collection that records the queries they run.
+    For operators mongomock does not implement, such as $text
+    """
+    from bson import ObjectId
+    from database import get_products_collection
+    
+    collection = RecordingCollection([{
+        "_id": ObjectId(),
+        "name": "Blue Notebook",
+        "description": "A blue notebook with a detailed description",
+        "price": 9.99,
+        "stock_quantity": 10,
+        "category": "Books",
+        "score": 1.5
+    }])
+    app.dependency_overrides[get_products_collection] = lambda: collection
+    yield collection
+    app.dependency_overrides.pop(get_products_collection, None)
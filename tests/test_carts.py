@@ -1,11 +1,12 @@
 import pytest
-from fastapi.testclient import TestClient
 from bson import ObjectId
 import asyncio
 
+pytestmark = pytest.mark.asyncio
+
 # Test that a cart is created automatically when a user is created
-def test_cart_created_with_user(client, sample_user_data):
-    response = client.post("/users/", json=sample_user_data)
+async def test_cart_created_with_user(client, sample_user_data):
+    response = await client.post("/users/", json=sample_user_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -14,7 +15,7 @@ def test_cart_created_with_user(client, sample_user_data):
     
     # Verify the cart exists and is associated with the user
     cart_id = data["cart_id"]
-    response = client.get(f"/carts/{cart_id}")
+    response = await client.get(f"/carts/{cart_id}")
     
     assert response.status_code == 200
     cart_data = response.json()
@@ -23,11 +24,11 @@ def test_cart_created_with_user(client, sample_user_data):
     assert cart_data["items"] == []
 
 # Test getting a cart by ID
-def test_get_cart_by_id(client, create_test_user):
+async def test_get_cart_by_id(client, create_test_user):
     user = create_test_user
     cart_id = user["cart_id"]
     
-    response = client.get(f"/carts/{cart_id}")
+    response = await client.get(f"/carts/{cart_id}")
     
     assert response.status_code == 200
     data = response.json()
@@ -37,26 +38,20 @@ def test_get_cart_by_id(client, create_test_user):
     assert isinstance(data["items"], list)
 
 # Test getting a non-existent cart
-def test_get_nonexistent_cart(client):
+async def test_get_nonexistent_cart(client):
     fake_id = str(ObjectId('99999461e07461e074699999'))
-    response = client.get(f"/carts/{fake_id}")
+    response = await client.get(f"/carts/{fake_id}")
     
     assert response.status_code == 404
 
 # Test getting a cart with invalid ID format
-def test_get_cart_invalid_id(client):
-    response1 = client.get("/carts/66e074")
-    response2 = client.get("/carts/123456")
-    response3 = client.get("/carts/------")
-    response4 = client.get("/carts/2034982304982304982304982304982304982304")   
-    
-    assert response1.status_code == 400
-    assert response2.status_code == 400
-    assert response3.status_code == 400
-    assert response4.status_code == 400
+@pytest.mark.parametrize("bad_id", ["66e074", "123456", "------", "2034982304982304982304982304982304982304"])
+async def test_get_cart_invalid_id(client, bad_id):
+    response = await client.get(f"/carts/{bad_id}")
+    assert response.status_code == 400
 
 # Test adding an item to a cart
-def test_add_item_to_cart(client, create_test_user, create_test_product):
+async def test_add_item_to_cart(client, create_test_user, create_test_product):
     user = create_test_user
     product = create_test_product
     cart_id = user["cart_id"]
@@ -66,7 +61,7 @@ def test_add_item_to_cart(client, create_test_user, create_test_product):
         "quantity": 2
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -75,8 +70,24 @@ def test_add_item_to_cart(client, create_test_user, create_test_product):
     assert data["items"][0]["product_id"] == product["id"]
     assert data["items"][0]["quantity"] == 2
 
+# Test adding an item to a non-existent cart
+async def test_add_item_to_nonexistent_cart(client, create_test_product, get_stock):
+    product = create_test_product
+    fake_id = str(ObjectId('99999461e07461e074699999'))
+
+    item_data = {
+        "product_id": product["id"],
+        "quantity": 2
+    }
+
+    response = await client.post(f"/carts/{fake_id}/items", json=item_data)
+    assert response.status_code == 404
+
+    # Check that product stock was not reserved
+    assert await get_stock(product["id"]) == product["stock_quantity"]
+
 # Test adding an item with invalid quantity
-def test_add_item_invalid_quantity(client, create_test_user, create_test_product):
+async def test_add_item_invalid_quantity(client, create_test_user, create_test_product):
     user = create_test_user
     product = create_test_product
     cart_id = user["cart_id"]
@@ -87,7 +98,7 @@ def test_add_item_invalid_quantity(client, create_test_user, create_test_product
         "quantity": 0
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 422
     
     # Try to add with negative quantity
@@ -96,11 +107,11 @@ def test_add_item_invalid_quantity(client, create_test_user, create_test_product
         "quantity": -1
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 422
 
 # Test adding more quantity of an existing item
-def test_add_more_of_existing_item(client, create_test_user, create_test_product):
+async def test_add_more_of_existing_item(client, create_test_user, create_test_product):
     user = create_test_user
     product = create_test_product
     cart_id = user["cart_id"]
@@ -111,7 +122,7 @@ def test_add_more_of_existing_item(client, create_test_user, create_test_product
         "quantity": 2
     }
     
-    client.post(f"/carts/{cart_id}/items", json=item_data)
+    await client.post(f"/carts/{cart_id}/items", json=item_data)
     
     # Add more of the same product
     item_data = {
@@ -119,7 +130,7 @@ def test_add_more_of_existing_item(client, create_test_user, create_test_product
         "quantity": 3
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -128,7 +139,7 @@ def test_add_more_of_existing_item(client, create_test_user, create_test_product
     assert data["items"][0]["quantity"] == 5  # 2 + 3 = 5
 
 # Test adding an item that exceeds available stock
-def test_add_item_exceeds_stock(client, create_test_user, create_test_product):
+async def test_add_item_exceeds_stock(client, create_test_user, create_test_product):
     user = create_test_user
     product = create_test_product
     cart_id = user["cart_id"]
@@ -139,11 +150,11 @@ def test_add_item_exceeds_stock(client, create_test_user, create_test_product):
         "quantity": product["stock_quantity"] + 1
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 400
 
 # Test updating item quantity in cart
-def test_update_item_quantity(client, create_test_cart_with_items):
+async def test_update_item_quantity(client, create_test_cart_with_items):
     cart = create_test_cart_with_items
     cart_id = cart["id"]
     product_id = cart["items"][0]["product_id"]
@@ -152,7 +163,7 @@ def test_update_item_quantity(client, create_test_cart_with_items):
         "quantity": 4
     }
     
-    response = client.put(f"/carts/{cart_id}/items/{product_id}", json=update_data)
+    response = await client.put(f"/carts/{cart_id}/items/{product_id}", json=update_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -161,13 +172,31 @@ def test_update_item_quantity(client, create_test_cart_with_items):
     assert data["items"][0]["product_id"] == product_id
     assert data["items"][0]["quantity"] == 4
 
+# Test updating item quantity adjusts product stock in both directions
+async def test_update_item_quantity_adjusts_stock(client, create_test_cart_with_items, get_stock):
+    cart = create_test_cart_with_items
+    cart_id = cart["id"]
+    product_id = cart["items"][0]["product_id"]
+    current_quantity = cart["items"][0]["quantity"]
+    initial_stock = await get_stock(product_id)
+
+    # Increasing the quantity takes more stock
+    await client.put(f"/carts/{cart_id}/items/{product_id}", json={"quantity": current_quantity + 3})
+    assert await get_stock(product_id) == initial_stock - 3
+
+    # Decreasing the quantity returns stock
+    await client.put(f"/carts/{cart_id}/items/{product_id}", json={"quantity": 1})
+    product = (await client.get(f"/products/{product_id}")).json()
+    assert product["stock_quantity"] == initial_stock + current_quantity - 1
+    assert product["is_active"] == True
+
 # Test removing an item from a cart
-def test_remove_item_from_cart(client, create_test_cart_with_items):
+async def test_remove_item_from_cart(client, create_test_cart_with_items):
     cart = create_test_cart_with_items
     cart_id = cart["id"]
     product_id = cart["items"][0]["product_id"]
     
-    response = client.delete(f"/carts/{cart_id}/items/{product_id}")
+    response = await client.delete(f"/carts/{cart_id}/items/{product_id}")
     
     assert response.status_code == 200
     data = response.json()
@@ -175,34 +204,54 @@ def test_remove_item_from_cart(client, create_test_cart_with_items):
     assert len(data["items"]) == 0
 
 # Test clearing a cart
-def test_clear_cart(client, create_test_cart_with_items):
+async def test_clear_cart(client, create_test_cart_with_items):
     cart = create_test_cart_with_items
     cart_id = cart["id"]
     
-    response = client.delete(f"/carts/{cart_id}/items")
+    response = await client.delete(f"/carts/{cart_id}/items")
     
     assert response.status_code == 200
     data = response.json()
     assert data["id"] == cart_id
     assert len(data["items"]) == 0
 
+# Test clearing a cart restores stock and reactivates sold-out products
+async def test_clear_cart_restores_stock(client, create_test_user, create_test_product):
+    user = create_test_user
+    product = create_test_product
+    cart_id = user["cart_id"]
+
+    # Add all available stock to make the product inactive
+    item_data = {
+        "product_id": product["id"],
+        "quantity": product["stock_quantity"]
+    }
+    await client.post(f"/carts/{cart_id}/items", json=item_data)
+
+    response = await client.delete(f"/carts/{cart_id}/items")
+    assert response.status_code == 200
+
+    # Check that the stock is fully restored and the product is active again
+    updated_product = (await client.get(f"/products/{product['id']}")).json()
+    assert updated_product["stock_quantity"] == product["stock_quantity"]
+    assert updated_product["is_active"] == True
+
 # Test deleting a cart
-def test_delete_cart(client, create_test_cart_with_items):
+async def test_delete_cart(client, create_test_cart_with_items, test_db):
     # Get the test cart with items
     cart = create_test_cart_with_items
     cart_id = cart["id"]
     
     # Get the initial product stock
     product_id = cart["items"][0]["product_id"]
-    initial_product = client.get(f"/products/{product_id}").json()
+    initial_product = await test_db.products.find_one({"_id": ObjectId(product_id)})
     initial_stock = initial_product["stock_quantity"]
     
     # Get the user associated with the cart
     user_id = cart["user_id"]
-    initial_user = client.get(f"/users/{user_id}").json()
     
     # Delete (checkout) the cart
-    response = client.delete(f"/carts/{cart_id}")
+    response = await client.delete(f"/carts/{cart_id}")
     
     # Verify response
     assert response.status_code == 200
@@ -212,26 +261,24 @@ def test_delete_cart(client, create_test_cart_with_items):
     assert "new_cart_id" in data
     new_cart_id = data["new_cart_id"]
     
-    # Verify the old cart is deleted
-    old_cart_response = client.get(f"/carts/{cart_id}")
-    assert old_cart_response.status_code == 404
-    
-    # Verify a new cart was created and is empty
-    new_cart_response = client.get(f"/carts/{new_cart_id}")
+    # Verify a new cart was created and is empty through the API
+    new_cart_response = await client.get(f"/carts/{new_cart_id}")
     assert new_cart_response.status_code == 200
     new_cart = new_cart_response.json()
     assert new_cart["id"] == new_cart_id
     assert new_cart["user_id"] == user_id
     assert new_cart["items"] == []
     
-    # Verify the user now has the new cart ID through the API
-    updated_user_response = client.get(f"/users/{user_id}")
-    assert updated_user_response.status_code == 200
-    updated_user = updated_user_response.json()
+    # Verify the rest of the stored state directly
+    # The old cart is deleted
+    assert await test_db.carts.find_one({"_id": ObjectId(cart_id)}) is None
+    
+    # The user now has the new cart ID
+    updated_user = await test_db.users.find_one({"_id": ObjectId(user_id)})
     assert updated_user["cart_id"] == new_cart_id
     
-    # Verify the product stock was reduced
-    updated_product = client.get(f"/products/{product_id}").json()
+    # The product stock was reduced
+    updated_product = await test_db.products.find_one({"_id": ObjectId(product_id)})
     item_quantity = cart["items"][0]["quantity"]
     assert updated_product["stock_quantity"] == initial_stock - item_quantity
     
@@ -240,7 +287,7 @@ def test_delete_cart(client, create_test_cart_with_items):
         assert updated_product["is_active"] == False
 
 # Test adding multiple different items to a cart
-def test_add_multiple_items(client, create_test_user):
+async def test_add_multiple_items(client, create_test_user):
     user = create_test_user
     cart_id = user["cart_id"]
     
@@ -254,7 +301,7 @@ def test_add_multiple_items(client, create_test_user):
             "stock_quantity": 10,
             "category": "Test"
         }
-        response = client.post("/products/", json=product_data)
+        response = await client.post("/products/", json=product_data)
         products.append(response.json())
     
     # Add each product to the cart
@@ -263,10 +310,10 @@ def test_add_multiple_items(client, create_test_user):
             "product_id": product["id"],
             "quantity": i + 1
         }
-        client.post(f"/carts/{cart_id}/items", json=item_data)
+        await client.post(f"/carts/{cart_id}/items", json=item_data)
     
     # Get the cart and verify all items are there
-    response = client.get(f"/carts/{cart_id}")
+    response = await client.get(f"/carts/{cart_id}")
     
     assert response.status_code == 200
     data = response.json()
@@ -279,7 +326,7 @@ def test_add_multiple_items(client, create_test_user):
         assert item["quantity"] == product_index + 1
 
 # Test stock decreases when item is added to cart
-def test_stock_decreases_when_item_added(client, create_test_product, create_test_user):
+async def test_stock_decreases_when_item_added(client, create_test_product, create_test_user, get_stock):
     product = create_test_product
     initial_stock = product["stock_quantity"]
     user = create_test_user
@@ -291,38 +338,31 @@ def test_stock_decreases_when_item_added(client, create_test_product, create_tes
         "quantity": 2
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 200
     
     # Check that product stock has decreased
-    product_response = client.get(f"/products/{product['id']}")
-    assert product_response.status_code == 200
-    updated_product = product_response.json()
-    assert updated_product["stock_quantity"] == initial_stock - 2
+    assert await get_stock(product["id"]) == initial_stock - 2
 
 # Test stock increases when item is removed from cart
-def test_stock_increases_when_item_removed(client, create_test_cart_with_items):
+async def test_stock_increases_when_item_removed(client, create_test_cart_with_items, get_stock):
     cart = create_test_cart_with_items
     cart_id = cart["id"]
     product_id = cart["items"][0]["product_id"]
     quantity = cart["items"][0]["quantity"]
     
     # Get initial product stock
-    product_response = client.get(f"/products/{product_id}")
-    initial_stock = product_response.json()["stock_quantity"]
+    initial_stock = await get_stock(product_id)
     
     # Remove item from cart
-    response = client.delete(f"/carts/{cart_id}/items/{product_id}")
+    response = await client.delete(f"/carts/{cart_id}/items/{product_id}")
     assert response.status_code == 200
     
     # Check that product stock has increased
-    product_response = client.get(f"/products/{product_id}")
-    assert product_response.status_code == 200
-    updated_product = product_response.json()
-    assert updated_product["stock_quantity"] == initial_stock + quantity
+    assert await get_stock(product_id) == initial_stock + quantity
 
 # Test validation against available stock
-def test_validation_against_available_stock(client, create_test_product, create_test_user):
+async def test_validation_against_available_stock(client, create_test_product, create_test_user):
     product = create_test_product
     available_stock = product["stock_quantity"]
     user = create_test_user
@@ -334,31 +374,29 @@ def test_validation_against_available_stock(client, create_test_product, create_
         "quantity": available_stock + 1
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 400
     assert "Not enough stock" in response.json()["detail"]
     
     # Add valid quantity
     item_data["quantity"] = available_stock
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 200
     
     # Try to add more (should fail as no stock left)
     item_data["quantity"] = 1
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 400
     assert "is not available" in response.json()["detail"]
 
 # Test updating cart item quantity validates against available stock
-def test_update_quantity_validates_stock(client, create_test_cart_with_items):
+async def test_update_quantity_validates_stock(client, create_test_cart_with_items, get_stock):
     cart = create_test_cart_with_items
     cart_id = cart["id"]
     product_id = cart["items"][0]["product_id"]
     
     # Get product to check available stock
-    product_response = client.get(f"/products/{product_id}")
-    product = product_response.json()
-    available_stock = product["stock_quantity"]
+    available_stock = await get_stock(product_id)
     current_cart_quantity = cart["items"][0]["quantity"]
     
     # Try to update to more than available stock
@@ -366,80 +404,87 @@ def test_update_quantity_validates_stock(client, create_test_cart_with_items):
         "quantity": current_cart_quantity + available_stock + 1
     }
     
-    response = client.put(f"/carts/{cart_id}/items/{product_id}", json=update_data)
+    response = await client.put(f"/carts/{cart_id}/items/{product_id}", json=update_data)
     assert response.status_code == 400
     assert "Not enough stock" in response.json()["detail"]
     
     # Update to valid quantity
     update_data["quantity"] = current_cart_quantity + available_stock
-    response = client.put(f"/carts/{cart_id}/items/{product_id}", json=update_data)
+    response = await client.put(f"/carts/{cart_id}/items/{product_id}", json=update_data)
     assert response.status_code == 200
 
 # Test complete checkout process
-def test_complete_checkout_process(client, create_test_user):
+async def test_complete_checkout_process(client, create_test_user, test_db):
     user = create_test_user
     user_id = user["id"]
     cart_id = user["cart_id"]
     
     # Create multiple products
-    products = []
-    for i in range(3):
-        product_data = {
+    responses = await asyncio.gather(*[
+        client.post("/products/", json={
             "name": f"Checkout Product {i}",
             "description": f"Product for checkout test {i}",
             "price": 10.99 + i,
             "stock_quantity": 10,
             "category": "Test"
-        }
-        response = client.post("/products/", json=product_data)
-        products.append(response.json())
+        })
+        for i in range(3)
+    ])
+    products = [response.json() for response in responses]
     
     # Add different quantities of each product to cart
-    for i, product in enumerate(products):
-        item_data = {
-            "product_id": product["id"],
-            "quantity": i + 1
-        }
-        client.post(f"/carts/{cart_id}/items", json=item_data)
+    await asyncio.gather(*[
+        client.post(f"/carts/{cart_id}/items", json={"product_id": product["id"], "quantity": i + 1})
+        for i, product in enumerate(products)
+    ])
     
     # Record initial stock levels
-    initial_stocks = {}
-    for product in products:
-        product_response = client.get(f"/products/{product['id']}")
-        initial_stocks[product["id"]] = product_response.json()["stock_quantity"]
+    product_oids = [ObjectId(product["id"]) for product in products]
+    stored_products = await test_db.products.find({"_id": {"$in": product_oids}}).to_list(None)
+    initial_stocks = {str(product["_id"]): product["stock_quantity"] for product in stored_products}
     
-    # Checkout (delete cart)
-    response = client.delete(f"/carts/{cart_id}")
+    # Checkout, getting back the resulting user and product state
+    response = await client.post(f"/carts/{cart_id}/checkout")
     assert response.status_code == 200
     data = response.json()
-    assert "new_cart_id" in data
+    assert "checked out successfully" in data["message"]
     new_cart_id = data["new_cart_id"]
     
-    # Verify old cart is gone
-    old_cart_response = client.get(f"/carts/{cart_id}")
-    assert old_cart_response.status_code == 404
+    # The user has the new cart
+    assert data["user"]["id"] == user_id
+    assert data["user"]["cart_id"] == new_cart_id
     
-    # Verify new cart exists and is empty
-    new_cart_response = client.get(f"/carts/{new_cart_id}")
-    assert new_cart_response.status_code == 200
-    new_cart = new_cart_response.json()
-    assert new_cart["items"] == []
-    
-    # Verify user has new cart
-    user_response = client.get(f"/users/{user_id}")
-    assert user_response.status_code == 200
-    updated_user = user_response.json()
-    assert updated_user["cart_id"] == new_cart_id
-    
-    # Verify all products have reduced stock
+    # All products have reduced stock
+    assert {product["id"] for product in data["products"]} == {product["id"] for product in products}
+    stock_by_id = {product["id"]: product for product in data["products"]}
     for i, product in enumerate(products):
-        product_response = client.get(f"/products/{product['id']}")
-        updated_product = product_response.json()
+        updated_product = stock_by_id[product["id"]]
         expected_stock = initial_stocks[product["id"]] - (i + 1)
         assert updated_product["stock_quantity"] == expected_stock
-        
-        # Check if product should be inactive
-        if expected_stock == 0:
-            assert updated_product["is_active"] == False
-        else:
-            assert updated_product["is_active"] == True
\ No newline at end of file
+        assert updated_product["is_active"] == (expected_stock > 0)
+    
+    # Verify new cart exists and is empty through the API
+    new_cart_response = await client.get(f"/carts/{new_cart_id}")
+    assert new_cart_response.status_code == 200
+    assert new_cart_response.json()["items"] == []
+    
+    # The old cart is gone
+    assert await test_db.carts.find_one({"_id": ObjectId(cart_id)}) is None
+
+# Test checkout works with the unique user_id index on carts in place
+async def test_delete_cart_with_indexes(client, create_test_cart_with_items):
+    import database
+    await database.create_indexes()
+    
+    cart = create_test_cart_with_items
+    response = await client.delete(f"/carts/{cart['id']}")
+    assert response.status_code == 200
+    
+    new_cart_response = await client.get(f"/carts/{response.json()['new_cart_id']}")
+    assert new_cart_response.status_code == 200
+    assert new_cart_response.json()["user_id"] == cart["user_id"]
+
+# Test checking out a cart that doesn't exist
+async def test_checkout_nonexistent_cart(client):
+    response = await client.post(f"/carts/{ObjectId()}/checkout")
+    assert response.status_code == 404
@@ -1,11 +1,14 @@
 import pytest
-from fastapi.testclient import TestClient
+import asyncio
 from bson import ObjectId
 from decimal import Decimal
+from routes.products import TEXT_SEARCH_PROJECTION, TEXT_SCORE_SORT, DEFAULT_SORT
+
+pytestmark = pytest.mark.asyncio
 
 # Test creating a new product
-def test_create_product(client, sample_product_data):
-    response = client.post("/products/", json=sample_product_data)
+async def test_create_product(client, sample_product_data):
+    response = await client.post("/products/", json=sample_product_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -18,58 +21,54 @@ def test_create_product(client, sample_product_data):
     assert data["is_active"] == True
 
 # Test creating a product with invalid data
-def test_create_product_invalid_data(client):
-    # Test with short name
-    response = client.post("/products/", json={
+@pytest.mark.parametrize("payload", [
+    # Short name
+    {
         "name": "A",
         "description": "This is a test product with a detailed description",
         "price": 19.99,
         "stock_quantity": 10
-    })
-    assert response.status_code == 422
-    
-    # Test with negative price
-    response = client.post("/products/", json={
+    },
+    # Negative price
+    {
         "name": "Test Product",
         "description": "This is a test product with a detailed description",
         "price": -19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    assert response.status_code == 422
-    
-    # Test with negative stock
-    response = client.post("/products/", json={
+    },
+    # Negative stock
+    {
         "name": "Test Product",
         "description": "This is a test product with a detailed description",
         "price": 19.99,
         "stock_quantity": -10,
         "category": "Test Category"
-    })
-    assert response.status_code == 422
-
-    response = client.post("/products/", json={
+    },
+    # Short description
+    {
         "name": "Test Product",
         "description": "This is a",
         "price": 19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    assert response.status_code == 422
-    
-    # Test with missing fields
-    response = client.post("/products/", json={
+    },
+    # Missing fields
+    {
         "name": "Test Product",
         "price": 19.99
-    })
+    },
+], ids=["short_name", "negative_price", "negative_stock", "short_description", "missing_fields"])
+async def test_create_product_invalid_data(client, payload):
+    response = await client.post("/products/", json=payload)
     assert response.status_code == 422
 
 # Test getting a product by ID
-def test_get_product_by_id(client, create_test_product):
+async def test_get_product_by_id(client, create_test_product):
     product = create_test_product
     product_id = product["id"]
     
-    response = client.get(f"/products/{product_id}")
+    response = await client.get(f"/products/{product_id}")
     
     assert response.status_code == 200
     data = response.json()
@@ -82,26 +81,20 @@ def test_get_product_by_id(client, create_test_product):
     assert data["is_active"] == product["is_active"]
 
 # Test getting a non-existent product
-def test_get_nonexistent_product(client):
+async def test_get_nonexistent_product(client):
     fake_id = str(ObjectId('99999461e07461e074619999'))
-    response = client.get(f"/products/{fake_id}")
+    response = await client.get(f"/products/{fake_id}")
     
     assert response.status_code == 404
 
 # Test getting a product with invalid ID format
-def test_get_product_invalid_id(client):
-    response1 = client.get("/products/66e074")
-    response2 = client.get("/products/123456")
-    response3 = client.get("/products/------")
-    response4 = client.get("/products/2034982304982304982304982304982304982304")
-    
-    assert response1.status_code == 400
-    assert response2.status_code == 400
-    assert response3.status_code == 400
-    assert response4.status_code == 400
+@pytest.mark.parametrize("bad_id", ["66e074", "123456", "------", "2034982304982304982304982304982304982304"])
+async def test_get_product_invalid_id(client, bad_id):
+    response = await client.get(f"/products/{bad_id}")
+    assert response.status_code == 400
 
 # Test updating a product
-def test_update_product(client, create_test_product):
+async def test_update_product(client, create_test_product):
     product = create_test_product
     product_id = product["id"]
     
@@ -113,7 +106,7 @@ def test_update_product(client, create_test_product):
         "category": "Updated Category"
     }
     
-    response = client.put(f"/products/{product_id}", json=update_data)
+    response = await client.put(f"/products/{product_id}", json=update_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -126,45 +119,43 @@ def test_update_product(client, create_test_product):
     assert data["is_active"] == True
 
 # Test updating a product with invalid data
-def test_update_product_invalid_data(client, create_test_product):
-    product = create_test_product
-    product_id = product["id"]
-    
-    
-    response1 = client.put(f"/products/{product_id}", json={
+@pytest.mark.parametrize("payload", [
+    # Short description
+    {
         "name": "Updated Product",
         "description": "This is a",
         "price": 19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    
-    assert response1.status_code == 422  
-
-    response2 = client.put(f"/products/{product_id}", json={
+    },
+    # Missing description and stock
+    {
         "name": "Updated Product",
         "price": 19.99
-    })
-    assert response2.status_code == 422
-    
-    response3 = client.put(f"/products/{product_id}", json={
+    },
+    # Missing description
+    {
         "name": "Updated Product",
         "price": 19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    assert response3.status_code == 422
-
-    response4 = client.put(f"/products/{product_id}", json={
+    },
+    # Negative price
+    {
         "name": "Updated Product",
         "price": -19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    assert response4.status_code == 422
+    },
+], ids=["short_description", "missing_fields", "missing_description", "negative_price"])
+async def test_update_product_invalid_data(client, create_test_product, payload):
+    product_id = create_test_product["id"]
+    
+    response = await client.put(f"/products/{product_id}", json=payload)
+    assert response.status_code == 422
 
 # Test partially updating a product
-def test_patch_product(client, create_test_product):
+async def test_patch_product(client, create_test_product):
     product = create_test_product
     product_id = product["id"]
     
@@ -174,7 +165,7 @@ def test_patch_product(client, create_test_product):
         "stock_quantity": 5
     }
     
-    response = client.patch(f"/products/{product_id}", json=update_data)
+    response = await client.patch(f"/products/{product_id}", json=update_data)
     
     assert response.status_code == 200
     data = response.json()
@@ -187,43 +178,43 @@ def test_patch_product(client, create_test_product):
     assert data["is_active"] == True
 
 # Test partially updating a product with invalid data
-def test_patch_product_invalid_data(client, create_test_product):
-    product = create_test_product
-    product_id = product["id"]
-    
-    response1 = client.patch(f"/products/{product_id}", json={
+@pytest.mark.parametrize("payload", [
+    # Negative price
+    {
         "price": -19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    assert response1.status_code == 422
-
-    response2 = client.patch(f"/products/{product_id}", json={
+    },
+    # Negative stock
+    {
         "price": 19.99,
         "stock_quantity": -10,
         "category": "Test Category"
-    })
-    assert response2.status_code == 422
-
-    response3 = client.patch(f"/products/{product_id}", json={
+    },
+    # Short description
+    {
         "name": "Updated Product",
         "description": "This is a",
         "price": 19.99,
         "stock_quantity": 10,
         "category": "Test Category"
-    })
-    assert response3.status_code == 422
-
-    response4 = client.patch(f"/products/{product_id}", json={
+    },
+    # Non-string category
+    {
         "name": "Updated Product",
         "description": "This is a test product with a detailed description",
         "stock_quantity": 10,
         "category": 123
-    })
-    assert response4.status_code == 422
+    },
+], ids=["negative_price", "negative_stock", "short_description", "non_string_category"])
+async def test_patch_product_invalid_data(client, create_test_product, payload):
+    product_id = create_test_product["id"]
+    
+    response = await client.patch(f"/products/{product_id}", json=payload)
+    assert response.status_code == 422
 
 # Test product becomes inactive when stock reaches zero
-def test_product_inactive_when_stock_zero(client, create_test_product, create_test_user):
+async def test_product_inactive_when_stock_zero(client, create_test_product, create_test_user):
     product = create_test_product
     user = create_test_user
     cart_id = user["cart_id"]
@@ -234,18 +225,18 @@ def test_product_inactive_when_stock_zero(client, create_test_product, create_te
         "quantity": product["stock_quantity"]
     }
     
-    response = client.post(f"/carts/{cart_id}/items", json=item_data)
+    response = await client.post(f"/carts/{cart_id}/items", json=item_data)
     assert response.status_code == 200
     
     # Check that product is now inactive
-    product_response = client.get(f"/products/{product['id']}")
+    product_response = await client.get(f"/products/{product['id']}")
     assert product_response.status_code == 200
     updated_product = product_response.json()
     assert updated_product["stock_quantity"] == 0
     assert updated_product["is_active"] == False
 
 # Test product becomes active again when stock is restored
-def test_product_active_when_stock_restored(client, create_test_product, create_test_user):
+async def test_product_active_when_stock_restored(client, create_test_product, create_test_user):
     product = create_test_product
     user = create_test_user
     cart_id = user["cart_id"]
@@ -256,26 +247,26 @@ def test_product_active_when_stock_restored(client, create_test_product, create_
         "quantity": product["stock_quantity"]
     }
     
-    client.post(f"/carts/{cart_id}/items", json=item_data)
+    await client.post(f"/carts/{cart_id}/items", json=item_data)
     
     # Verify product is inactive
-    product_response = client.get(f"/products/{product['id']}")
+    product_response = await client.get(f"/products/{product['id']}")
     updated_product = product_response.json()
     assert updated_product["is_active"] == False
     
     # Now remove the item from cart to restore stock
-    response = client.delete(f"/carts/{cart_id}/items/{product['id']}")
+    response = await client.delete(f"/carts/{cart_id}/items/{product['id']}")
     assert response.status_code == 200
     
     # Check that product is active again
-    product_response = client.get(f"/products/{product['id']}")
+    product_response = await client.get(f"/products/{product['id']}")
     assert product_response.status_code == 200
     restored_product = product_response.json()
     assert restored_product["stock_quantity"] > 0
     assert restored_product["is_active"] == True
 
 # Test updating product stock directly
-def test_update_product_stock(client, create_test_product):
+async def test_update_product_stock(client, create_test_product):
     product = create_test_product
     product_id = product["id"]
     
@@ -284,17 +275,45 @@ def test_update_product_stock(client, create_test_product):
         "stock_quantity": 20
     }
     
-    response = client.patch(f"/products/{product_id}", json=update_data)
+    response = await client.patch(f"/products/{product_id}", json=update_data)
     assert response.status_code == 200
     updated_product = response.json()
     assert updated_product["stock_quantity"] == 20
 
+# Test patching stock to zero deactivates the stored product
+async def test_patch_product_stock_to_zero(client, create_test_product):
+    product = create_test_product
+    product_id = product["id"]
+    
+    response = await client.patch(f"/products/{product_id}", json={"stock_quantity": 0, "name": "$Sold Out"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["is_active"] == False
+    assert data["name"] == "$Sold Out"  # Stored literally, not read as a field path
+    
+    # The stored is_active flag used for filtering is updated too
+    response = await client.get("/products/", params={"is_active": False})
+    assert [item["id"] for item in response.json()["items"]] == [product_id]
+
+# Test patching with explicit nulls
+async def test_patch_product_null_fields(client, create_test_product):
+    product_id = create_test_product["id"]
+    
+    # An explicit null clears the optional category
+    response = await client.patch(f"/products/{product_id}", json={"category": None})
+    assert response.status_code == 200
+    assert response.json()["category"] is None
+    
+    # Required fields can be left out, but not cleared
+    response = await client.patch(f"/products/{product_id}", json={"name": None})
+    assert response.status_code == 422
+
 # Test deleting a product
-def test_delete_product(client, create_test_product):
+async def test_delete_product(client, create_test_product):
     product = create_test_product
     product_id = product["id"]
     
-    response = client.delete(f"/products/{product_id}")
+    response = await client.delete(f"/products/{product_id}")
     
     assert response.status_code == 200
     data = response.json()
@@ -302,16 +321,23 @@ def test_delete_product(client, create_test_product):
     assert f"Product with ID {product_id} deleted successfully" in data["message"]
     
     # Verify the product is actually deleted
-    get_response = client.get(f"/products/{product_id}")
+    get_response = await client.get(f"/products/{product_id}")
     assert get_response.status_code == 404
 
+# Test deleting a non-existent product
+async def test_delete_nonexistent_product(client):
+    fake_id = str(ObjectId('99999461e07461e074619999'))
+    response = await client.delete(f"/products/{fake_id}")
+    
+    assert response.status_code == 404
+
 # Test getting all products
-def test_get_all_products(client):
+async def test_get_all_products(client):
     # Create multiple products
     categories = ["Electronics", "Books", "Clothing"]
     prices = [9.99, 19.99, 29.99, 39.99, 49.99]
     
-    for i in range(5):
+    await asyncio.gather(*[
         client.post("/products/", json={
             "name": f"Test Product {i}",
             "description": f"This is test product {i} with a detailed description",
@@ -319,8 +345,10 @@ def test_get_all_products(client):
             "stock_quantity": 10 * (i + 1),
             "category": categories[i % len(categories)]
         })
+        for i in range(5)
+    ])
     
-    response = client.get("/products/")
+    response = await client.get("/products/")
     
     assert response.status_code == 200
     data = response.json()
@@ -358,4 +386,135 @@ def test_get_all_products(client):
             assert "price" in product
             assert "stock_quantity" in product
             assert "category" in product
-            assert "is_active" in product 
\ No newline at end of file
+            assert "is_active" in product 
+
+# Test searching products with regex matching
+async def test_search_products_regex(client):
+    for name in ["Blue Notebook", "Red Pen", "Blue Pen"]:
+        await client.post("/products/", json={
+            "name": name,
+            "description": f"{name} with a detailed description",
+            "price": 9.99,
+            "stock_quantity": 10,
+            "category": "Stationery"
+        })
+    
+    response = await client.get("/products/", params={"search": "blue", "search_mode": "regex"})
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["total"] == 2
+    assert {product["name"] for product in data["items"]} == {"Blue Notebook", "Blue Pen"}
+
+# Test searching products by name prefix
+async def test_search_products_prefix(client):
+    for name in ["Blue Notebook", "Navy Blue Pen", "C++ Primer"]:
+        await client.post("/products/", json={
+            "name": name,
+            "description": f"{name} with a detailed description",
+            "price": 9.99,
+            "stock_quantity": 10,
+            "category": "Books"
+        })
+    
+    response = await client.get("/products/", params={"search": "Blue", "search_mode": "prefix"})
+    assert response.status_code == 200
+    assert [product["name"] for product in response.json()["items"]] == ["Blue Notebook"]
+    
+    # The prefix is case-sensitive, so it can use the name index
+    response = await client.get("/products/", params={"search": "blue", "search_mode": "prefix"})
+    assert response.status_code == 200
+    assert response.json()["items"] == []
+    
+    # Regex metacharacters are matched literally
+    response = await client.get("/products/", params={"search": "C++", "search_mode": "prefix"})
+    assert response.status_code == 200
+    assert [product["name"] for product in response.json()["items"]] == ["C++ Primer"]
+
+# Test the default text search query, projection and sort handed to the database
+async def test_search_products_text(client, recording_products_collection):
+    response = await client.get("/products/", params={"search": "blue"})
+    assert response.status_code == 200
+    data = response.json()
+    assert [product["name"] for product in data["items"]] == ["Blue Notebook"]
+    assert data["total"] == 1
+    
+    [(query, projection, cursor)] = recording_products_collection.finds
+    assert query == {"$text": {"$search": "blue"}}
+    assert projection == TEXT_SEARCH_PROJECTION
+    assert cursor.sort_query == TEXT_SCORE_SORT
+
+# Test that an explicit sort or a keyset cursor replaces the text score sort
+async def test_search_products_text_without_score_sort(client, recording_products_collection):
+    response = await client.get("/products/", params={"search": "blue", "sort_by": "price", "sort_order": -1})
+    assert response.status_code == 200
+    
+    after_id = str(ObjectId())
+    response = await client.get("/products/", params={"search": "blue", "after_id": after_id})
+    assert response.status_code == 200
+    
+    [(sorted_query, _, sorted_cursor), (keyset_query, _, keyset_cursor)] = recording_products_collection.finds
+    assert sorted_query == {"$text": {"$search": "blue"}}
+    assert sorted_cursor.sort_query == [("price", -1)]
+    assert keyset_query == {"$text": {"$search": "blue"}, "_id": {"$gt": ObjectId(after_id)}}
+    assert keyset_cursor.sort_query == DEFAULT_SORT
+
+# Test paging past the end while the cached filtered count is stale
+async def test_get_products_skip_past_stale_count(client):
+    responses = await asyncio.gather(*[
+        client.post("/products/", json={
+            "name": f"Test Product {i}",
+            "description": f"This is test product {i} with a detailed description",
+            "price": 9.99,
+            "stock_quantity": 10,
+            "category": "X"
+        })
+        for i in range(15)
+    ])
+    
+    # Warm the count cache for this filter
+    response = await client.get("/products/", params={"category": "X"})
+    assert response.json()["total"] == 15
+    
+    for product_response in responses[:10]:
+        await client.delete(f"/products/{product_response.json()['id']}")
+    
+    response = await client.get("/products/", params={"category": "X", "skip": 10, "limit": 1})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["items"] == []
+    assert data["has_more"] == False
+    assert data["next_cursor"] is None
+
+# Test paging through products with the keyset cursor
+async def test_get_products_keyset_pagination(client):
+    for i in range(5):
+        await client.post("/products/", json={
+            "name": f"Test Product {i}",
+            "description": f"This is test product {i} with a detailed description",
+            "price": 9.99,
+            "stock_quantity": 10,
+            "category": "Books"
+        })
+    
+    names = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["after_id"] = cursor
+        response = await client.get("/products/", params=params)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["total"] == 5
+        names.extend(product["name"] for product in data["items"])
+        cursor = data["next_cursor"]
+        if not data["has_more"]:
+            assert cursor is None
+            break
+    
+    assert names == [f"Test Product {i}" for i in range(5)]
+    
+    # The cursor only works with the default _id ordering
+    response = await client.get("/products/", params={"after_id": str(ObjectId()), "sort_by": "price"})
+    assert response.status_code == 400
@@ -1,119 +1,104 @@
 import pytest
-from fastapi.testclient import TestClient
+import asyncio
 from bson import ObjectId
 
+pytestmark = pytest.mark.asyncio
+
+# IDs shared by the lookup tests
+FAKE_USER_ID = str(ObjectId('66e07461e07461e07461e074'))  # Well-formed but never stored
+INVALID_IDS = ("66e074", "123456", "------", "2034982304982304982304982304982304982304")
+
 # Test creating a new user
-def test_create_user(client, sample_user_data):
-    response = client.post("/users/", json=sample_user_data)
+async def test_create_user(client, sample_user_data, test_db):
+    response = await client.post("/users/", json=sample_user_data)
     
     assert response.status_code == 200
     user = response.json()
-    assert "id" in user
+    assert user.keys() >= {"id", "name", "email", "cart_id"}
     assert user["name"] == sample_user_data["name"]
     assert user["email"] == sample_user_data["email"]
     
-    # Verify cart_id is included and not None
-    assert "cart_id" in user
+    # Verify cart_id is not None
     assert user["cart_id"] is not None
     
-    # Verify the cart exists and is associated with the user
-    cart_response = client.get(f"/carts/{user['cart_id']}")
-    assert cart_response.status_code == 200
-    cart = cart_response.json()
+    # Verify the cart was stored and is associated with the user
+    # (the GET /carts/{cart_id} endpoint is covered in test_carts)
+    cart = await test_db["carts"].find_one({"_id": ObjectId(user["cart_id"])})
+    assert cart is not None
     assert cart["user_id"] == user["id"]
     assert cart["items"] == []
 
 # Test creating a user with invalid data
-def test_create_user_invalid_data(client):
-    # Test with short name
-    response = client.post("/users/", json={"name": "A", "email": "test@example.com"})
-    assert response.status_code == 422
-    
-    # Test with invalid email
-    response = client.post("/users/", json={"name": "Test User", "email": "invalid-email"})
-    assert response.status_code == 422
-    
-    # Test with missing fields
-    response = client.post("/users/", json={"name": "Test User"})
+@pytest.mark.parametrize("payload", [
+    # Short name
+    {"name": "A", "email": "test@example.com"},
+    # Invalid email
+    {"name": "Test User", "email": "invalid-email"},
+    # Missing fields
+    {"name": "Test User"},
+], ids=["short_name", "invalid_email", "missing_fields"])
+async def test_create_user_invalid_data(client, payload):
+    response = await client.post("/users/", json=payload)
     assert response.status_code == 422
 
-# Test getting a user by ID
-def test_get_user_by_id(client, create_test_user):
+# Test getting, updating, patching and deleting one user
+async def test_user_lifecycle(client, create_test_user, get_user_from_db):
     user = create_test_user
     user_id = user["id"]
     
-    response = client.get(f"/users/{user_id}")
+    # Get the user by ID, including its cart
+    response = await client.get(f"/users/{user_id}")
     
     assert response.status_code == 200
     data = response.json()
     assert data["id"] == user_id
     assert data["name"] == user["name"]
     assert data["email"] == user["email"]
-    assert "cart_id" in data
-
-# Test getting a non-existent user
-def test_get_nonexistent_user(client):
-    fake_id = str(ObjectId('66e07461e07461e07461e074'))
-    response = client.get(f"/users/{fake_id}")
-    
-    assert response.status_code == 404
-
-# Test getting a user with invalid ID format
-def test_get_user_invalid_id(client):
-    response1 = client.get("/users/66e074")
-    response2 = client.get("/users/123456")
-    response3 = client.get("/users/------")
-    response4 = client.get("/users/2034982304982304982304982304982304982304")
-    
-    assert response1.status_code == 400
-    assert response2.status_code == 400
-    assert response3.status_code == 400
-    assert response4.status_code == 400 
-
-# Test updating a user
-def test_update_user(client, create_test_user):
-    user = create_test_user
-    user_id = user["id"]
+    assert data["cart_id"] is not None
+    assert data["cart_id"] == user["cart_id"]
     
+    # Full update
     update_data = {
         "name": "Updated User",
         "email": "updated@example.com"
     }
     
-    response = client.put(f"/users/{user_id}", json=update_data)
+    response = await client.put(f"/users/{user_id}", json=update_data)
     
     assert response.status_code == 200
     data = response.json()
     assert data["id"] == user_id
     assert data["name"] == update_data["name"]
     assert data["email"] == update_data["email"]
-    assert "cart_id" in data
-
-# Test partially updating a user
-def test_patch_user(client, create_test_user):
-    user = create_test_user
-    user_id = user["id"]
+    assert data["cart_id"] == user["cart_id"]
+    
+    # The stored user is updated in place and keeps its cart
+    [stored_user] = await get_user_from_db([user_id])
+    assert stored_user["name"] == update_data["name"]
+    assert stored_user["cart_id"] == user["cart_id"]
     
     # Update only the name
-    update_data = {
+    patch_data = {
         "name": "Partially Updated User"
     }
     
-    response = client.patch(f"/users/{user_id}", json=update_data)
+    response = await client.patch(f"/users/{user_id}", json=patch_data)
     
     assert response.status_code == 200
     data = response.json()
     assert data["id"] == user_id
-    assert data["name"] == update_data["name"]
-    assert data["email"] == user["email"]  # Email should remain unchanged
-    assert "cart_id" in data
-
-# Test deleting a user
-def test_delete_user(client, create_test_user):
-    user = create_test_user
-    user_id = user["id"]
+    assert data["name"] == patch_data["name"]
+    assert data["email"] == update_data["email"]  # Email should remain unchanged
+    assert data["cart_id"] == user["cart_id"]
+    
+    # The patch is visible on a later read
+    response = await client.get(f"/users/{user_id}")
+    
+    assert response.status_code == 200
+    assert response.json() == data
     
-    response = client.delete(f"/users/{user_id}")
+    # Delete the user
+    response = await client.delete(f"/users/{user_id}")
     
     assert response.status_code == 200
     data = response.json()
@@ -121,60 +106,101 @@ def test_delete_user(client, create_test_user):
     assert f"User with ID {user_id} deleted successfully" in data["message"]
     
     # Verify the user is actually deleted
-    get_response = client.get(f"/users/{user_id}")
+    get_response = await client.get(f"/users/{user_id}")
     assert get_response.status_code == 404
 
+# Test updating a user to an email another user already has
+async def test_update_user_duplicate_email(client, create_test_user):
+    import database
+    await database.create_indexes()
+    
+    user = create_test_user
+    response = await client.post("/users/", json={"name": "Other User", "email": "other@example.com"})
+    other_user_id = response.json()["id"]
+    
+    response = await client.put(f"/users/{other_user_id}", json={"name": "Other User", "email": user["email"]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == f"User with email {user['email']} already exists"
+    
+    response = await client.patch(f"/users/{other_user_id}", json={"email": user["email"]})
+    assert response.status_code == 400
+    assert response.json()["detail"] == f"User with email {user['email']} already exists"
+
+# Test getting a non-existent user
+async def test_get_nonexistent_user(client):
+    response = await client.get(f"/users/{FAKE_USER_ID}")
+    
+    assert response.status_code == 404
+
+# Test getting a user with invalid ID format
+@pytest.mark.parametrize("bad_id", INVALID_IDS)
+async def test_get_user_invalid_id(client, bad_id):
+    response = await client.get(f"/users/{bad_id}")
+    assert response.status_code == 400
+
 # Test getting all users
-def test_get_all_users(client):
+async def test_get_all_users(client):
     # Create multiple users
-    for i in range(5):
+    await asyncio.gather(*[
         client.post("/users/", json={
             "name": f"Test User {i}",
             "email": f"test{i}@example.com"
         })
+        for i in range(5)
+    ])
     
-    response = client.get("/users/")
+    response = await client.get("/users/")
     
     assert response.status_code == 200
     data = response.json()
     
     # Check if it's a paginated response
-    assert "items" in data
-    assert "total" in data
-    assert "skip" in data
-    assert "limit" in data
-    assert "has_more" in data
+    assert data.keys() >= {"items", "total", "skip", "limit", "has_more"}
     
     # Verify we have at least 5 users
     assert len(data["items"]) >= 5
     
     # Verify the structure of each user
     for user in data["items"]:
-        assert "id" in user
-        assert "name" in user
-        assert "email" in user
-        assert "cart_id" in user 
+        assert user.keys() >= {"id", "name", "email", "cart_id"}
 
-# Test that cart_id is included in user responses
-def test_get_user_includes_cart_id(client, create_test_user):
-    user = create_test_user
-    user_id = user["id"]
+# Test paging through users with the keyset cursor
+async def test_get_users_keyset_pagination(client):
+    for i in range(5):
+        await client.post("/users/", json={
+            "name": f"Test User {i}",
+            "email": f"test{i}@example.com"
+        })
     
-    response = client.get(f"/users/{user_id}")
+    response = await client.get("/users/", params={"limit": 3})
+    assert response.status_code == 200
+    first_page = response.json()
+    assert first_page["has_more"] == True
+    assert first_page["next_cursor"] == first_page["items"][-1]["id"]
     
+    response = await client.get("/users/", params={"limit": 3, "after_id": first_page["next_cursor"]})
     assert response.status_code == 200
-    user_data = response.json()
-    assert "cart_id" in user_data
-    assert user_data["cart_id"] is not None
-    assert user_data["cart_id"] == user["cart_id"]
+    second_page = response.json()
+    assert second_page["total"] == 5
+    assert len(second_page["items"]) == 2
+    assert second_page["has_more"] == False
+    assert second_page["next_cursor"] is None
+    
+    # Pages do not overlap
+    first_ids = {user["id"] for user in first_page["items"]}
+    assert first_ids.isdisjoint(user["id"] for user in second_page["items"])
+    
+    # Invalid cursor
+    response = await client.get("/users/", params={"after_id": "123456"})
+    assert response.status_code == 400
 
 # Test that cart_id is included in list users response
-def test_list_users_includes_cart_id(client, create_test_user):
-    response = client.get("/users/")
+async def test_list_users_includes_cart_id(client, create_test_user):
+    response = await client.get("/users/")
     
     assert response.status_code == 200
     data = response.json()
-    assert "items" in data
+    assert data.keys() >= {"items", "total", "skip", "limit", "has_more"}
     assert len(data["items"]) > 0
     
     # Check that at least one user has a cart_id